@@ -0,0 +1,150 @@
+from time import monotonic, time
+from hashlib import sha256
+
+from django.conf import settings
+from django.db import transaction
+from redis import RedisError
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from ujson import dumps, loads
+
+from .models import *
+from .lookups import LRUCache
+from .store import get_redis
+
+
+__all__ = [
+    'CachedTokenAuthentication',
+    'token_cache',
+]
+
+CACHED_FIELDS = {'id', 'email', 'username', 'first_name', 'last_name', 'company', 'position',
+                 'type', 'is_active', 'is_staff', 'is_superuser'}
+# from_db() expects values in the order of the model fields
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields
+               if field.attname in CACHED_FIELDS]
+TOKEN_KEY = 'auth:token:{}'
+REVOKED_KEY = 'auth:revoked:{}'
+
+
+class TokenCache:
+    '''
+    Кеш token -> поля пользователя в два уровня: LRU процесса (записи живут
+    AUTH_LOCAL_TIMEOUT секунд) и Redis (AUTH_CACHE_TIMEOUT). Инвалидация
+    удаляет ключ из Redis и локального LRU и ставит в Redis метку отзыва,
+    по которой другие процессы отбрасывают свои локальные записи, взятые
+    раньше нее; без Redis локальная запись живет до AUTH_LOCAL_TIMEOUT
+    '''
+    def __init__(self, maxsize=None):
+        self.local = LRUCache(maxsize or settings.AUTH_CACHE_SIZE)
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @staticmethod
+    def redis_key(key, template=TOKEN_KEY):
+        return template.format(sha256(key.encode()).hexdigest())
+
+    def revoked(self, key, cached_at):
+        '''whether another process invalidated the token after cached_at'''
+        try:
+            revoked_at = get_redis().get(self.redis_key(key, REVOKED_KEY))
+        except RedisError:
+            return False
+        return revoked_at is not None and float(revoked_at) >= cached_at
+
+    def get(self, key):
+        '''user field values for the token, None if it is not cached'''
+        entry = self.local.get(key)
+        if entry is not None and entry[0] > monotonic() and not self.revoked(key, entry[1]):
+            return entry[2]
+        if entry is not None:
+            self.local.delete(key)
+        try:
+            data = get_redis().get(self.redis_key(key))
+        except RedisError:
+            return None
+        if data is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        values = loads(data)
+        self.local.set(key, (monotonic() + settings.AUTH_LOCAL_TIMEOUT, time(), values))
+        return values
+
+    def set(self, key, values, read_at):
+        '''
+        cache values read from the database at read_at; a revocation after
+        the read means they may predate it, the write is undone then
+        '''
+        try:
+            get_redis().set(self.redis_key(key), dumps(values), ex=settings.AUTH_CACHE_TIMEOUT)
+        except RedisError:
+            pass
+        # checked after the write: a revocation between the two deletes the key itself
+        if self.revoked(key, read_at):
+            try:
+                get_redis().delete(self.redis_key(key))
+            except RedisError:
+                pass
+            return
+        self.local.set(key, (monotonic() + settings.AUTH_LOCAL_TIMEOUT, read_at, values))
+
+    def invalidate(self, keys):
+        '''forget tokens now and once more after commit, so no reader caches old rows'''
+        keys = list(keys)
+
+        def forget():
+            for key in keys:
+                self.local.delete(key)
+            # local entries of other processes live AUTH_LOCAL_TIMEOUT at most
+            now = time()
+            try:
+                with get_redis().pipeline() as pipeline:
+                    pipeline.delete(*[self.redis_key(key) for key in keys])
+                    for key in keys:
+                        pipeline.set(self.redis_key(key, REVOKED_KEY), now,
+                                     ex=settings.AUTH_LOCAL_TIMEOUT)
+                    pipeline.execute()
+            except RedisError:
+                pass
+        if keys:
+            forget()
+            transaction.on_commit(forget)
+
+    def clear(self):
+        self.local.clear()
+        self.redis_hits = self.redis_misses = 0
+
+    def stats(self):
+        return {'local': self.local.stats(),
+                'redis': {'hits': self.redis_hits, 'misses': self.redis_misses}}
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    TokenAuthentication без запроса к БД на каждый вызов: пользователь
+    по токену берется из token_cache. Пароль, last_login и date_joined
+    не кешируются и подгружаются из БД при обращении
+    '''
+    def authenticate_credentials(self, key):
+        values = token_cache.get(key)
+        if values is None:
+            read_at = time()
+            row = Token.objects.filter(key=key).values_list(
+                *[f'user__{field}' for field in USER_FIELDS]).first()
+            if row is None:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            values = list(row)
+            token_cache.set(key, values, read_at)
+
+        user = User.from_db(User.objects.db, USER_FIELDS, values)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return user, key
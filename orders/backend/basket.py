@@ -0,0 +1,117 @@
+from django.db import connection, transaction
+from django.db.models import Case, Count, IntegerField, OuterRef, Subquery, Value, When
+
+from .models import *
+from .serializers import BasketItemSerializer, BasketQuantitySerializer
+
+
+__all__ = [
+    'get_basket',
+    'add_to_basket',
+    'update_basket',
+    'basket_summary',
+]
+
+def get_basket(user_id):
+    basket, _ = Order.objects.get_or_create(user_id=user_id, status='basket')
+    return basket
+
+
+def add_to_basket(user_id, items):
+    '''
+    Добавление позиций в корзину пачкой: цены одним запросом, новые позиции
+    одним bulk_create, количество существующих складывается одним bulk_update.
+    Результат - список по каждой переданной позиции
+    '''
+    results, quantities = [], {}
+    for item in items:
+        serializer = BasketItemSerializer(data=item)
+        if serializer.is_valid():
+            product_info_id = serializer.validated_data['product_info']
+            quantity = serializer.validated_data['quantity']
+            quantities[product_info_id] = quantities.get(product_info_id, 0) + quantity
+            results.append({'product_info': product_info_id, 'quantity': quantity})
+        else:
+            results.append({'status': 'error', 'errors': serializer.errors})
+
+    prices = dict(ProductInfo.objects.filter(
+        id__in=quantities, shop__state=True).values_list('id', 'price'))
+    statuses = {}
+    with transaction.atomic():
+        basket = get_basket(user_id)
+        existing = {order_item.product_info_id: order_item for order_item
+                    in OrderItem.objects.select_for_update().filter(
+                        order_id=basket.id, product_info_id__in=prices)}
+        new_items, changed_items = [], []
+        for product_info_id, price in prices.items():
+            order_item = existing.get(product_info_id)
+            if order_item is None:
+                order_item = OrderItem(order_id=basket.id, product_info_id=product_info_id,
+                                       quantity=0)
+                new_items.append(order_item)
+                statuses[product_info_id] = 'created'
+            else:
+                changed_items.append(order_item)
+                statuses[product_info_id] = 'updated'
+            order_item.quantity += quantities[product_info_id]
+            order_item.price = price
+            order_item.total_amount = price * order_item.quantity
+
+        OrderItem.objects.bulk_create(new_items)
+        OrderItem.objects.bulk_update(changed_items, ('quantity', 'price', 'total_amount'))
+        if new_items or changed_items:
+            Order.update_totals([basket.id])
+
+    if new_items and not connection.features.can_return_rows_from_bulk_insert:
+        ids = dict(OrderItem.objects.filter(
+            order_id=basket.id, product_info_id__in=[item.product_info_id for item in new_items]
+        ).values_list('product_info_id', 'id'))
+        for order_item in new_items:
+            order_item.id = ids[order_item.product_info_id]
+    order_items = {order_item.product_info_id: order_item
+                   for order_item in new_items + changed_items}
+
+    for result in results:
+        order_item = order_items.get(result.get('product_info'))
+        if order_item is not None:
+            result.update(status=statuses[order_item.product_info_id], id=order_item.id)
+        elif 'errors' not in result:
+            result.update(status='error', errors={'product_info': ['Product is not available']})
+    return results
+
+
+def basket_summary(basket_id):
+    '''totals of the basket from the Order row'''
+    return Order.objects.filter(id=basket_id).annotate(
+        items=Count('ordered_items')).values(
+        'id', 'items', 'total_quantity', 'total_sum').get()
+
+
+def update_basket(user_id, items):
+    '''
+    Изменение количества позиций корзины одним UPDATE: quantity через
+    CASE по id, price - текущая цена предложения, total_amount считается
+    в том же выражении. Возвращает (число обновленных, ошибки, итоги корзины)
+    '''
+    quantities, errors = {}, []
+    for item in items:
+        serializer = BasketQuantitySerializer(data=item)
+        if serializer.is_valid():
+            quantities[serializer.validated_data['id']] = serializer.validated_data['quantity']
+        else:
+            errors.append({'item': item, 'errors': serializer.errors})
+
+    basket = get_basket(user_id)
+    updated = 0
+    if quantities:
+        quantity = Case(*[When(id=order_item_id, then=Value(value))
+                          for order_item_id, value in quantities.items()],
+                        output_field=IntegerField())
+        price = Subquery(ProductInfo.objects.filter(
+            id=OuterRef('product_info_id')).values('price')[:1])
+        with transaction.atomic():
+            updated = OrderItem.objects.filter(order_id=basket.id, id__in=quantities).update(
+                quantity=quantity, price=price, total_amount=price * quantity)
+            if updated:
+                Order.update_totals([basket.id])
+    return updated, errors, basket_summary(basket.id)
@@ -0,0 +1,383 @@
+import os
+import tracemalloc
+from time import perf_counter, sleep
+from threading import Thread
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from tempfile import TemporaryDirectory
+from collections import deque
+
+from yaml import safe_load
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from .models import *
+from .pricelist import read_price_list
+from .search import search_catalog
+
+
+__all__ = [
+    'BENCHMARKS',
+    'write_price_list',
+    'SMTPStandIn',
+]
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def write_price_list(path, goods_count, shop='Benchmark', price=1000):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(f'shop: {shop}\n'
+                   'categories:\n'
+                   '  - id: 224\n'
+                   '    name: Смартфоны\n'
+                   '  - id: 15\n'
+                   '    name: Аксессуары\n'
+                   'goods:\n')
+        for i in range(goods_count):
+            file.write(f'  - id: {1000 + i}\n'
+                       f'    category: {224 if i % 2 else 15}\n'
+                       f'    model: model/{i}\n'
+                       f'    name: Товар {i}\n'
+                       f'    price: {price}\n'
+                       f'    price_rrc: {price + 100}\n'
+                       f'    quantity: 10\n'
+                       f'    parameters:\n'
+                       f'      "Цвет": черный\n'
+                       f'      "Память (Гб)": {64 * (i % 4 + 1)}\n')
+
+
+class Server(ThreadingTCPServer):
+    daemon_threads = True
+
+
+class SMTPStandIn:
+    '''
+    Локальный SMTP сервер для тестов и бенчмарков: принимает все письма,
+    считает соединения, отклоняет адреса из refuse; handshake_delay -
+    задержка приветствия, как у удаленного сервера
+    '''
+    def __init__(self, refuse=(), handshake_delay=0):
+        self.connections = 0
+        self.messages = []
+        stand_in = self
+
+        class Handler(StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(f'{line}\r\n'.encode())
+
+            def handle(self):
+                stand_in.connections += 1
+                sleep(handshake_delay)
+                self.reply('220 localhost')
+                recipients = []
+                for line in self.rfile:
+                    command = line.decode().strip()
+                    verb = command[:4].upper()
+                    if verb in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif verb == 'MAIL':
+                        recipients = []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        address = command.partition(':')[2].strip().strip('<>')
+                        if address in refuse:
+                            self.reply('550 No such user')
+                        else:
+                            recipients.append(address)
+                            self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line.rstrip(b'\r\n') == b'.':
+                                break
+                            data.append(data_line)
+                        stand_in.messages.append((recipients, b''.join(data)))
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('250 OK')
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def settings(self):
+        '''EMAIL_* settings pointing at the stand-in'''
+        return {'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend',
+                'EMAIL_HOST': '127.0.0.1', 'EMAIL_PORT': self.port,
+                'EMAIL_USE_SSL': False, 'EMAIL_USE_TLS': False,
+                'EMAIL_HOST_USER': 'shop@benchmark.local', 'EMAIL_HOST_PASSWORD': ''}
+
+    def __enter__(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def traced_peak(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark('pricelist')
+def pricelist_memory(sizes, write):
+    '''peak memory of streaming price list parsing against safe_load'''
+    with TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f'{size}.yaml')
+            write_price_list(path, size)
+
+            started = perf_counter()
+            count = sum(1 for _ in read_price_list(path))
+            elapsed = perf_counter() - started
+            stream_peak = traced_peak(lambda: deque(read_price_list(path), maxlen=0))
+            line = (f'{size:>9} goods {os.path.getsize(path) / 2 ** 20:>7.1f} MiB '
+                    f'stream peak {stream_peak / 2 ** 10:>7.0f} KiB '
+                    f'{count / elapsed:>7.0f} events/s')
+            if size <= 10000:
+                with open(path, 'rb') as file:
+                    load_peak = traced_peak(lambda: safe_load(file))
+                line += f' | safe_load peak {load_peak / 2 ** 10:>7.0f} KiB'
+            write(line)
+
+
+class Rollback(Exception):
+    pass
+
+
+@benchmark('search')
+def search_latency(sizes, write):
+    '''ranked catalog search latency, data is rolled back afterwards'''
+    from .importer import PriceListImporter
+
+    queries = ['товар', 'черный 128', 'model/7', 'нет такого']
+    for size in sizes:
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(email=f'search-{size}@benchmark.local',
+                                                password='benchmark', type='shop')
+                with TemporaryDirectory() as directory:
+                    path = os.path.join(directory, 'price.yaml')
+                    write_price_list(path, size)
+                    PriceListImporter(user_id=user.id).run_events(read_price_list(path))
+
+                for query in queries:
+                    queryset = search_catalog(CatalogEntry.objects.filter(shop_state=True), query)
+                    with CaptureQueriesContext(connection) as context:
+                        started = perf_counter()
+                        found = len(queryset[:50])
+                        elapsed = perf_counter() - started
+                    write(f'{size:>9} rows {query!r:>14} {found:>3} found '
+                          f'{elapsed * 1000:>8.2f} ms {len(context)} queries')
+                raise Rollback
+        except Rollback:
+            pass
+
+
+@benchmark('serializers')
+def serializer_throughput(sizes, write):
+    '''rows/s of list fast paths against the per-field DRF serializers'''
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.serializers import ListSerializer
+    from .importer import PriceListImporter
+    from .lookups import category_lookup, parameter_lookup, clear_lookups
+    from .serializers import ProductInfoSerializer, OrderSerializer
+
+    def measure(serializer):
+        started = perf_counter()
+        content = JSONRenderer().render(serializer.data)
+        return content, perf_counter() - started
+
+    for size in sizes:
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(email=f'serializers-{size}@benchmark.local',
+                                                password='benchmark', type='shop')
+                with TemporaryDirectory() as directory:
+                    path = os.path.join(directory, 'price.yaml')
+                    write_price_list(path, size)
+                    PriceListImporter(user_id=user.id).run_events(read_price_list(path))
+
+                product_infos = ProductInfo.objects.filter(shop__user=user).order_by('id')
+                ids = list(product_infos.values_list('id', flat=True))
+                orders = Order.objects.bulk_create(
+                    [Order(user=user, status='new') for _ in range(0, len(ids), 10)])
+                if not connection.features.can_return_rows_from_bulk_insert:
+                    orders = list(Order.objects.filter(user=user).order_by('id'))
+                OrderItem.objects.bulk_create(
+                    [OrderItem(order=orders[index // 10], product_info_id=product_info_id,
+                               quantity=1, price=1000, total_amount=1000)
+                     for index, product_info_id in enumerate(ids)], batch_size=1000)
+                Order.update_totals([order.id for order in orders])
+                # name caches fill on commit, warm them so both paths read names from memory
+                category_lookup.names.set_many(dict(Category.objects.values_list('id', 'name')))
+                parameter_lookup.names.set_many(dict(Parameter.objects.values_list('id', 'name')))
+                orders = Order.objects.filter(user=user).prefetch_related(
+                    'ordered_items__product_info__product',
+                    'ordered_items__product_info__product_parameters')
+
+                for name, queryset, serializer in (
+                        ('product_infos', product_infos, ProductInfoSerializer),
+                        ('orders', orders, OrderSerializer)):
+                    legacy, legacy_time = measure(ListSerializer(
+                        queryset.prefetch_related('product', 'product_parameters')
+                        if serializer is ProductInfoSerializer else queryset,
+                        child=serializer()))
+                    fast, fast_time = measure(serializer(queryset, many=True))
+                    write(f'{size:>9} rows {name:>14} serializer {size / legacy_time:>9.0f} rows/s '
+                          f'fast path {size / fast_time:>9.0f} rows/s '
+                          f'x{legacy_time / fast_time:.1f} identical={legacy == fast}')
+                raise Rollback
+        except Rollback:
+            clear_lookups()
+
+
+@benchmark('checkout')
+def checkout_throughput(sizes, write):
+    '''parallel buyers of one hot SKU: reservation engine against read-check-write'''
+    from time import sleep
+    from concurrent.futures import ThreadPoolExecutor
+    from django.db import OperationalError
+    from .importer import PriceListImporter
+    from .reservations import reserve_order
+
+    def naive(order_id):
+        product_info_id, quantity = OrderItem.objects.filter(order_id=order_id).values_list(
+            'product_info_id', 'quantity').get()
+        with transaction.atomic():
+            stock = ProductInfo.objects.get(id=product_info_id).quantity
+            if stock < quantity:
+                return 'rejected'
+            ProductInfo.objects.filter(id=product_info_id).update(quantity=stock - quantity)
+            return 'reserved'
+
+    def run(engine, order_ids, retries):
+        def checkout(order_id):
+            try:
+                while True:
+                    try:
+                        return engine(order_id)
+                    except OperationalError:
+                        # SQLite gives up on lock upgrades instead of waiting
+                        retries.append(1)
+                        sleep(0.001)
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(16) as executor:
+            return list(executor.map(checkout, order_ids))
+
+    for size in sizes:
+        stock = size // 2
+        shop_user = User.objects.create_user(email=f'checkout-{size}@benchmark.local',
+                                             password='benchmark', type='shop')
+        try:
+            PriceListImporter(user_id=shop_user.id).run({
+                'shop': f'Checkout {size}', 'categories': [{'id': 224, 'name': 'Смартфоны'}],
+                'goods': [{'id': 1, 'category': 224, 'model': 'hot', 'name': f'Hot SKU {size}',
+                           'price': 1000, 'price_rrc': 1100, 'quantity': stock,
+                           'parameters': {}}]})
+            product_info = ProductInfo.objects.get(shop__user=shop_user)
+            User.objects.bulk_create([User(email=f'buyer-{size}-{i}@benchmark.local',
+                                           username=f'buyer-{size}-{i}', password='!')
+                                      for i in range(size)])
+            buyers = list(User.objects.filter(email__startswith=f'buyer-{size}-'))
+
+            for name, engine in (('reservation', lambda order_id: reserve_order(order_id)['status']),
+                                 ('read-check-write', naive)):
+                ProductInfo.objects.filter(id=product_info.id).update(quantity=stock)
+                Order.objects.filter(user__in=buyers).delete()
+                Order.objects.bulk_create([Order(user=buyer, status='new') for buyer in buyers])
+                orders = list(Order.objects.filter(user__in=buyers))
+                OrderItem.objects.bulk_create([OrderItem(order=order, product_info=product_info,
+                                                         quantity=1, price=1000)
+                                               for order in orders])
+                retries = []
+                started = perf_counter()
+                statuses = run(engine, [order.id for order in orders], retries)
+                elapsed = perf_counter() - started
+                left = ProductInfo.objects.get(id=product_info.id).quantity
+                sold = statuses.count('reserved')
+                write(f'{size:>6} buyers {name:>17} {size / elapsed:>8.0f} checkouts/s '
+                      f'sold {sold:>5} of {stock:>5} stock left {left:>5} '
+                      f'oversold {max(sold + left - stock, 0):>5} lock retries {len(retries)}')
+        finally:
+            User.objects.filter(email__startswith=f'buyer-{size}-').delete()
+            shop_user.delete()
+            Product.objects.filter(name=f'Hot SKU {size}').delete()
+
+
+@benchmark('outbox')
+def outbox_throughput(sizes, write):
+    '''messages/s of a connection per message against outbox batches over one connection'''
+    from django.core.mail import EmailMultiAlternatives
+    from django.test.utils import override_settings
+    from .outbox import drain_outbox_messages
+
+    # a remote server answers in tens of milliseconds, the stand-in adds it to the greeting
+    with SMTPStandIn(handshake_delay=0.02) as server, override_settings(**server.settings()):
+        for size in sizes:
+            try:
+                with transaction.atomic():
+                    messages = [OutboxMessage(subject=f'Order {i}', body='Order is formed',
+                                              to_email=f'buyer-{i}@benchmark.local')
+                                for i in range(size)]
+                    server.connections = 0
+                    started = perf_counter()
+                    for message in messages:
+                        EmailMultiAlternatives(message.subject, message.body, None,
+                                               [message.to_email]).send()
+                    single_time, single_connections = perf_counter() - started, server.connections
+
+                    OutboxMessage.objects.bulk_create(messages)
+                    server.connections = 0
+                    started = perf_counter()
+                    result = drain_outbox_messages()
+                    outbox_time = perf_counter() - started
+                    write(f'{size:>7} messages connection per message {size / single_time:>7.0f} msg/s '
+                          f'{single_connections:>6} connections | outbox {size / outbox_time:>7.0f} msg/s '
+                          f'{server.connections:>3} connections sent {result["sent"]}')
+                    raise Rollback
+            except Rollback:
+                pass
+
+
+@benchmark('throttle')
+def throttle_overhead(sizes, write):
+    '''per request cost of DRF cache throttle history against the shared token bucket'''
+    from types import SimpleNamespace
+    from django.conf import settings
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.cache import cache
+    from rest_framework.throttling import AnonRateThrottle
+    from .store import get_redis
+    from .throttling import SharedAnonRateThrottle
+
+    store = 'in-process fake' if settings.REDIS_URL.startswith('memory://') else 'redis'
+    for size in sizes:
+        request = SimpleNamespace(user=AnonymousUser(), META={'REMOTE_ADDR': f'10.0.0.{size % 250}'})
+        line = f'{size:>8} requests from one client'
+        for name, base in (('cache history', AnonRateThrottle),
+                           (f'token bucket ({store})', SharedAnonRateThrottle)):
+            throttle_class = type('BenchmarkThrottle', (base,), {'rate': f'{size * 2}/day'})
+            cache.clear()
+            get_redis().delete(throttle_class().get_cache_key(request, None))
+            started = perf_counter()
+            allowed = sum(throttle_class().allow_request(request, None) for _ in range(size))
+            elapsed = perf_counter() - started
+            line += f' | {name} {elapsed / size * 10 ** 6:>7.1f} us/request allowed {allowed}'
+        write(line)
@@ -0,0 +1,226 @@
+from math import ceil
+from time import time
+from contextlib import contextmanager
+from hashlib import sha1
+from itertools import islice
+from threading import local
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from redis import RedisError
+from rest_framework.mixins import ListModelMixin
+from rest_framework.response import Response
+from ujson import dumps, loads
+
+from .models import *
+from .store import get_redis
+
+
+__all__ = [
+    'bump_catalog_version',
+    'catalog_version',
+    'catalog_state',
+    'set_cached_catalog',
+    'CatalogListMixin',
+    'refresh_catalog_entries',
+    'catalog_signals_paused',
+    'pause_catalog_signals',
+]
+
+GLOBAL_VERSION_KEY = 'catalog:version'
+OFFERS_VERSION_KEY = 'catalog:version:offers'
+SHOP_VERSION_KEY = 'catalog:version:shop:{}'
+RESPONSE_KEY = 'catalog:response:{}'
+MODIFIED_KEY = '{}:modified'
+
+paused = local()
+
+
+def bump_catalog_version(shop_id=None):
+    '''
+    Новая версия каталога после коммита: shop_id - изменились товары магазина,
+    None - изменились общие данные (категории, магазины)
+    '''
+    def bump():
+        try:
+            keys = ([GLOBAL_VERSION_KEY] if shop_id is None
+                    else [SHOP_VERSION_KEY.format(shop_id), OFFERS_VERSION_KEY])
+            # rounded up: a later change can not share the second of this one
+            now = ceil(time())
+            with get_redis().pipeline() as pipeline:
+                for key in keys:
+                    pipeline.incr(key)
+                    pipeline.set(MODIFIED_KEY.format(key), now)
+                pipeline.execute()
+        except RedisError:
+            pass
+    transaction.on_commit(bump)
+
+
+def version_keys(shop_id=None):
+    return [GLOBAL_VERSION_KEY,
+            OFFERS_VERSION_KEY if shop_id is None else SHOP_VERSION_KEY.format(shop_id)]
+
+
+def catalog_version(shop_id=None):
+    '''version marker of all offers or of one shop offers, None if store is down'''
+    return catalog_state(shop_id)[0]
+
+
+def catalog_state(shop_id=None):
+    '''
+    (version marker, last modified timestamp) одним MGET, (None, None)
+    если хранилище недоступно
+    '''
+    keys = version_keys(shop_id)
+    modified_keys = [MODIFIED_KEY.format(key) for key in keys]
+    try:
+        values = get_redis().mget(keys + modified_keys)
+        if None in values[len(keys):]:
+            now = ceil(time())
+            with get_redis().pipeline() as pipeline:
+                for key in modified_keys:
+                    pipeline.set(key, now, nx=True)
+                pipeline.mget(modified_keys)
+                values[len(keys):] = pipeline.execute()[-1]
+    except RedisError:
+        return None, None
+    version = '.'.join((value or b'0').decode() for value in values[:len(keys)])
+    return version, max(int(value) for value in values[len(keys):])
+
+
+def response_digest(scope, params, version):
+    query = '&'.join(f'{key}={value}' for key, value in sorted(params.lists()))
+    return sha1(f'{scope}|{version}|{query}'.encode()).hexdigest()
+
+
+def cached_catalog(key):
+    try:
+        data = get_redis().get(key)
+    except RedisError:
+        return None
+    return loads(data) if data is not None else None
+
+
+def set_cached_catalog(key, data):
+    if key is None:
+        return
+    try:
+        get_redis().set(key, dumps(data, ensure_ascii=False),
+                        ex=settings.CATALOG_CACHE_TIMEOUT)
+    except RedisError:
+        pass
+
+
+class CatalogListMixin:
+    '''
+    list() каталога: ответ из Redis по версии каталога, ETag и Last-Modified
+    из той же версии; совпавший If-None-Match / If-Modified-Since дает 304
+    без запросов к БД и сериализации. Last-Modified - время записи версии,
+    округленное вверх, отдается только после наступления этой секунды;
+    If-Modified-Since учитывается только без If-None-Match
+    '''
+    catalog_scope = None
+
+    def get_catalog_shop_id(self):
+        return None
+
+    def get_catalog_data(self, request, *args, **kwargs):
+        return ListModelMixin.list(self, request, *args, **kwargs).data
+
+    def list(self, request, *args, **kwargs):
+        version, modified = catalog_state(self.get_catalog_shop_id())
+        if version is None:
+            return Response(self.get_catalog_data(request, *args, **kwargs))
+
+        digest = response_digest(self.catalog_scope, request.query_params, version)
+        headers = {'ETag': quote_etag(f'{digest}-{request.accepted_renderer.format}')}
+        if modified < time():
+            headers['Last-Modified'] = http_date(modified)
+        else:
+            # a change later in the same second would get the same stamp
+            modified = None
+        response = get_conditional_response(
+            request, etag=headers['ETag'],
+            last_modified=None if 'HTTP_IF_NONE_MATCH' in request.META else modified)
+        if response is None:
+            key = RESPONSE_KEY.format(digest)
+            data = cached_catalog(key)
+            if data is None:
+                data = self.get_catalog_data(request, *args, **kwargs)
+                set_cached_catalog(key, data)
+            response = Response(data)
+        for header, value in headers.items():
+            response[header] = value
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+
+def refresh_catalog_entries(product_info_ids, batch_size=None):
+    '''
+    Пересобрать строки CatalogEntry для ProductInfo: 2 запроса на чтение
+    и delete + executemany INSERT на пачку
+    '''
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    iterator = iter(product_info_ids)
+    while True:
+        ids = list(islice(iterator, batch_size))
+        if not ids:
+            return
+        parameters = {}
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=ids).order_by('id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            parameters.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+
+        entries = [
+            CatalogEntry(product_info_id=product_info_id, shop_id=shop_id, shop_state=shop_state,
+                         category_id=category_id, category_name=category_name,
+                         product_name=product_name, model=model, quantity=quantity,
+                         price=price, price_rrc=price_rrc,
+                         parameters=parameters.get(product_info_id, []),
+                         search_text=' '.join(parameter['value'] for parameter
+                                              in parameters.get(product_info_id, [])))
+            for (product_info_id, shop_id, shop_state, category_id, category_name,
+                 product_name, model, quantity, price, price_rrc) in ProductInfo.objects.filter(
+                id__in=ids).values_list(
+                'id', 'shop_id', 'shop__state', 'product__category_id', 'product__category__name',
+                'product__name', 'model', 'quantity', 'price', 'price_rrc')]
+        CatalogEntry.objects.filter(product_info_id__in=ids).delete()
+        insert_entries(entries)
+
+
+@contextmanager
+def pause_catalog_signals():
+    '''
+    Массовые изменения предложений: сигналы ProductInfo и ProductParameter
+    в этом потоке не трогают CatalogEntry, вызывающий обновляет ее сам
+    '''
+    paused.depth = getattr(paused, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        paused.depth -= 1
+
+
+def catalog_signals_paused():
+    return getattr(paused, 'depth', 0) > 0
+
+
+def insert_entries(entries):
+    '''
+    INSERT строк каталога одним executemany на пачку: bulk_create делит
+    пачку по лимиту параметров запроса (на SQLite 83 строки на INSERT)
+    '''
+    if not entries:
+        return
+    fields = CatalogEntry._meta.concrete_fields
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(CatalogEntry._meta.db_table), ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [[field.get_db_prep_save(getattr(entry, field.attname), connection)
+                                  for field in fields] for entry in entries])
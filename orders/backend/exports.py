@@ -0,0 +1,78 @@
+import csv
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from ujson import dumps
+
+from .models import *
+from .partner import shop_orders
+
+
+__all__ = [
+    'EXPORT_TYPES',
+    'order_export',
+    'catalog_export',
+    'export_response',
+]
+
+ORDER_COLUMNS = ('order_id', 'dt', 'status', 'product_info_id', 'external_id', 'model',
+                 'quantity', 'price', 'total_amount')
+CATALOG_COLUMNS = ('id', 'external_id', 'model', 'name', 'category_id', 'category',
+                   'quantity', 'price', 'price_rrc')
+EXPORT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    '''file-like object for csv.writer, write() returns the line'''
+    def write(self, value):
+        return value
+
+
+def order_export(user_id, filters):
+    '''
+    (колонки, строки) позиций магазина в его заказах: одна строка на позицию,
+    заказы отобраны как в ленте заказов магазина
+    '''
+    rows = OrderItem.objects.filter(
+        product_info__shop__user_id=user_id,
+        order_id__in=shop_orders(user_id, filters).values('id')).order_by(
+        '-order__dt', '-order_id', 'id').values_list(
+        'order_id', 'order__dt', 'order__status', 'product_info_id', 'product_info__external_id',
+        'product_info__model', 'quantity', 'price', 'total_amount')
+    return ORDER_COLUMNS, ((order_id, dt.isoformat(), *row) for order_id, dt, *row
+                           in rows.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE))
+
+
+def catalog_export(user_id):
+    '''(колонки, строки) предложений магазина владельца user_id'''
+    rows = ProductInfo.objects.filter(shop__user_id=user_id).order_by('id').values_list(
+        'id', 'external_id', 'model', 'product__name', 'product__category_id',
+        'product__category__name', 'quantity', 'price', 'price_rrc')
+    return CATALOG_COLUMNS, rows.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(columns, rows):
+    for row in rows:
+        yield dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def export_response(export_type, columns, rows, filename):
+    '''
+    Потоковый ответ выгрузки: строки пишутся по мере чтения курсора,
+    в памяти только текущая пачка EXPORT_CHUNK_SIZE
+    '''
+    lines = csv_lines if export_type == 'csv' else ndjson_lines
+    response = StreamingHttpResponse(lines(columns, rows),
+                                     content_type=EXPORT_TYPES[export_type])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_type}"'
+    return response
@@ -0,0 +1,81 @@
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Count, Exists, OuterRef
+
+from .models import *
+from .lookups import parameter_lookup
+
+
+__all__ = [
+    'parse_catalog_filters',
+    'filter_catalog',
+    'catalog_facets',
+]
+
+TRUE_VALUES = {'1', 'true', 'yes', 'on'}
+
+
+def parse_price(value, name):
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'Invalid {name}')
+    if not price.is_finite() or price < 0:
+        raise ValueError(f'Invalid {name}')
+    return price
+
+
+def parse_catalog_filters(params):
+    '''
+    Фильтры каталога из query params: param=Имя:значение (повторяется,
+    значения одного параметра объединяются через ИЛИ), price_min, price_max, in_stock
+    '''
+    parameters = {}
+    for pair in params.getlist('param'):
+        name, separator, value = pair.partition(':')
+        if not separator or not name or not value:
+            raise ValueError('Invalid param, expected Name:Value')
+        parameters.setdefault(name, set()).add(value)
+
+    filters = {'parameters': parameters}
+    for name in ('price_min', 'price_max'):
+        if params.get(name):
+            filters[name] = parse_price(params[name], name)
+    if params.get('in_stock'):
+        filters['in_stock'] = params['in_stock'].lower() in TRUE_VALUES
+    return filters
+
+
+def filter_catalog(queryset, filters):
+    '''apply parse_catalog_filters() result to CatalogEntry queryset'''
+    if 'price_min' in filters:
+        queryset = queryset.filter(price__gte=filters['price_min'])
+    if 'price_max' in filters:
+        queryset = queryset.filter(price__lte=filters['price_max'])
+    if filters.get('in_stock'):
+        queryset = queryset.filter(quantity__gt=0)
+
+    parameters = filters.get('parameters')
+    if parameters:
+        parameter_ids = parameter_lookup.get_ids(parameters)
+        if len(parameter_ids) < len(parameters):
+            return queryset.none()
+        for name, values in parameters.items():
+            queryset = queryset.filter(Exists(ProductParameter.objects.filter(
+                product_info_id=OuterRef('pk'), parameter_id=parameter_ids[name],
+                value__in=values)))
+    return queryset
+
+
+def catalog_facets(queryset):
+    '''
+    {parameter: {value: count}} for entries of the queryset, one grouped query
+    '''
+    facets = {}
+    rows = ProductParameter.objects.filter(
+        product_info_id__in=queryset.order_by().values('pk')).values_list(
+        'parameter__name', 'value').annotate(count=Count('pk')).order_by(
+        'parameter__name', 'value')
+    for name, value, count in rows:
+        facets.setdefault(name, {})[value] = count
+    return facets
@@ -0,0 +1,88 @@
+import os
+from hashlib import sha1
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+
+
+__all__ = [
+    'FeedResult',
+    'fetch_feeds',
+]
+
+class FeedResult:
+    '''
+    Результат загрузки прайса магазина по Shop.url
+    '''
+    def __init__(self, shop, status, path=None, etag='', last_modified='',
+                 content_hash='', error=''):
+        self.shop = shop
+        self.status = status
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.error = error
+
+    def discard(self):
+        if self.path:
+            os.remove(self.path)
+            self.path = None
+
+
+def make_session(pool_size):
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_feed(session, shop):
+    '''conditional GET of shop price list into a temporary file'''
+    headers = {}
+    if shop.feed_etag:
+        headers['If-None-Match'] = shop.feed_etag
+    if shop.feed_last_modified:
+        headers['If-Modified-Since'] = shop.feed_last_modified
+
+    try:
+        with session.get(shop.url, headers=headers, stream=True,
+                         timeout=settings.PRICE_FEED_TIMEOUT) as response:
+            if response.status_code == 304:
+                return FeedResult(shop, 'not_modified',
+                                  etag=shop.feed_etag,
+                                  last_modified=shop.feed_last_modified,
+                                  content_hash=shop.feed_hash)
+            response.raise_for_status()
+
+            digest = sha1()
+            with NamedTemporaryFile(suffix='.yaml', delete=False) as file:
+                try:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        digest.update(chunk)
+                        file.write(chunk)
+                except Exception:
+                    os.remove(file.name)
+                    raise
+            result = FeedResult(shop, 'changed', path=file.name,
+                                etag=response.headers.get('ETag', ''),
+                                last_modified=response.headers.get('Last-Modified', ''),
+                                content_hash=digest.hexdigest())
+    except (RequestException, OSError) as error:
+        return FeedResult(shop, 'failed', error=str(error))
+
+    if result.content_hash == shop.feed_hash:
+        result.discard()
+        result.status = 'unchanged'
+    return result
+
+
+def fetch_feeds(shops, workers=None):
+    '''fetch price lists concurrently over one pooled session'''
+    workers = workers or settings.PRICE_FEED_WORKERS
+    with make_session(workers) as session, ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda shop: fetch_feed(session, shop), shops))
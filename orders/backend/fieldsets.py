@@ -0,0 +1,126 @@
+__all__ = [
+    'Fieldset',
+    'PRODUCT_INFO_FIELDS',
+    'PRODUCT_INFO_EXPANDABLE',
+    'ORDER_FIELDS',
+    'ORDER_EXPANDABLE',
+]
+
+PRODUCT_INFO_FIELDS = {
+    'id': None,
+    'model': None,
+    'product': {'name': None, 'category': None},
+    'shop': None,
+    'quantity': None,
+    'price': None,
+    'price_rrc': None,
+    'product_parameters': {'parameter': None, 'value': None},
+}
+PRODUCT_INFO_EXPANDABLE = {'product_parameters'}
+
+ORDER_FIELDS = {
+    'id': None,
+    'ordered_items': {'id': None, 'product_info': PRODUCT_INFO_FIELDS, 'quantity': None},
+    'status': None,
+    'dt': None,
+    'total_sum': None,
+    'contact': {'id': None, 'city': None, 'street': None, 'house': None,
+                'apartment': None, 'phone': None},
+}
+ORDER_EXPANDABLE = {'contact', 'ordered_items.product_info',
+                    'ordered_items.product_info.product_parameters'}
+
+
+def split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Fieldset:
+    '''
+    Выбор полей ответа: ?fields=id,product.name,price - только эти поля
+    (через точку - вложенные), ?expand=contact - связи, которые раскрываются
+    объектом. Без expand раскрыты все связи, нераскрытая связь выводится
+    своим id или не выводится, если id у нее нет
+    '''
+    def __init__(self, schema, expandable, fields=None, expand=None):
+        self.expandable = expandable
+        self.fields = fields
+        self.selected = None
+        if fields is not None:
+            self.selected = {}
+            for path in fields:
+                self.select(schema, path)
+        self.expand = None
+        if expand is not None:
+            unknown = set(expand) - expandable
+            if unknown:
+                raise ValueError(f'Invalid expand: {", ".join(sorted(unknown))}')
+            self.expand = set(expand)
+
+    @classmethod
+    def from_request(cls, request, schema, expandable):
+        params = request.query_params
+        return cls(schema, expandable,
+                   split(params['fields']) if 'fields' in params else None,
+                   split(params['expand']) if 'expand' in params else None)
+
+    @property
+    def is_full(self):
+        return self.selected is None and self.expand is None
+
+    def select(self, schema, path):
+        node, level = self.selected, schema
+        parts = path.split('.')
+        for index, part in enumerate(parts):
+            if level is None or part not in level:
+                raise ValueError(f'Invalid field: {path}')
+            if index == len(parts) - 1:
+                node[part] = True
+            elif node.get(part) is not True:
+                node = node.setdefault(part, {})
+                level = level[part]
+            else:
+                return
+
+    def wants(self, path):
+        '''path or some of its subfields is in the response'''
+        node = self.selected
+        for part in path.split('.'):
+            if node is None or node is True:
+                return True
+            if part not in node:
+                return False
+            node = node[part]
+        return True
+
+    def expanded(self, path):
+        '''relation at path is rendered as an object'''
+        if self.expand is None or path in self.expand:
+            return True
+        prefix = f'{path}.'
+        return any(field.startswith(prefix) for field in self.fields or ())
+
+    def apply(self, rows):
+        '''prune full representations to the requested fields'''
+        if self.is_full:
+            return rows
+        return [self.prune(row, self.selected or True, '') for row in rows]
+
+    def prune(self, value, selected, path):
+        if isinstance(value, list):
+            return [self.prune(item, selected, path) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for name, item in value.items():
+            item_selected = True if selected is True else selected.get(name)
+            if item_selected is None:
+                continue
+            item_path = f'{path}{name}'
+            if item_path in self.expandable and not self.expanded(item_path):
+                if isinstance(item, list):
+                    continue
+                result[name] = item.get('id') if isinstance(item, dict) else item
+            else:
+                result[name] = self.prune(item, item_selected, f'{item_path}.')
+        return result
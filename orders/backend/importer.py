@@ -0,0 +1,323 @@
+from json import dumps
+from hashlib import sha1
+from time import perf_counter
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import *
+from .pricelist import iter_price_list
+from .lookups import category_lookup, parameter_lookup, product_lookup
+from .catalog import bump_catalog_version, pause_catalog_signals, refresh_catalog_entries
+
+
+__all__ = [
+    'PriceListImporter',
+]
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def content_hash(item):
+    return sha1(dumps(item, sort_keys=True, ensure_ascii=False,
+                      default=str).encode()).hexdigest()
+
+
+class PriceListImporter:
+    '''
+    Пакетный импорт прайса магазина
+    '''
+    def __init__(self, user_id=None, shop=None, batch_size=None, progress=None,
+                 incremental=True):
+        self.user_id = user_id
+        self.shop = shop
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        self.incremental = incremental
+        self.progress = progress
+        self.phase = 'queued'
+        self.rows = {
+            'categories': 0,
+            'products': 0,
+            'parameters': 0,
+            'product_infos': 0,
+            'product_parameters': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'deleted': 0,
+        }
+        self.timings = {}
+        self.seen_external_ids = set()
+
+    def run(self, data):
+        '''import parsed price list'''
+        return self.run_events(iter_price_list(data))
+
+    def run_events(self, events):
+        '''import stream of (kind, value) price list events'''
+        started = perf_counter()
+        with transaction.atomic(), pause_catalog_signals():
+            categories, goods = [], []
+            for kind, value in events:
+                if kind == 'shop':
+                    self.import_shop(value)
+                elif kind == 'category':
+                    categories.append(value)
+                elif kind == 'good':
+                    if categories is not None:
+                        self.start_goods(categories)
+                        categories = None
+                    goods.append(value)
+                    if len(goods) >= self.batch_size:
+                        self.import_goods(goods)
+                        self.notify()
+                        goods = []
+            if categories is not None:
+                self.start_goods(categories)
+            if goods:
+                self.import_goods(goods)
+            if self.incremental:
+                self.set_phase('delete')
+                self.delete_stale_product_infos()
+            bump_catalog_version(self.shop.id)
+        self.timings['total'] = perf_counter() - started
+        self.set_phase('done')
+        return self.report()
+
+    def start_goods(self, categories):
+        if self.shop is None:
+            raise ValueError('Price list must start with shop')
+        self.set_phase('categories')
+        self.import_categories(categories)
+        if not self.incremental:
+            self.set_phase('delete')
+            self.delete_product_infos()
+        self.set_phase('goods')
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.notify()
+
+    def notify(self):
+        if self.progress is not None:
+            self.progress(self)
+
+    def report(self):
+        total = self.timings.get('total') or 0
+        return {
+            'shop': self.shop.name,
+            'batch_size': self.batch_size,
+            'mode': 'incremental' if self.incremental else 'replace',
+            'rows': dict(self.rows),
+            'timings': {phase: round(seconds, 4)
+                        for phase, seconds in self.timings.items()},
+            'rate': round(self.rows['product_infos'] / total) if total else None,
+        }
+
+    def timed(self, phase, started):
+        self.timings[phase] = self.timings.get(phase, 0) + perf_counter() - started
+
+    def import_shop(self, name):
+        if self.shop is None:
+            self.shop, _ = Shop.objects.get_or_create(user_id=self.user_id,
+                                                      defaults={'name': name})
+
+    def import_categories(self, categories):
+        started = perf_counter()
+        names = {category['id']: category['name'] for category in categories}
+        existing = set()
+        for ids in chunked(names, self.batch_size):
+            existing.update(category_lookup.get_ids(ids))
+
+        new_categories = [Category(id=category_id, name=name)
+                          for category_id, name in names.items()
+                          if category_id not in existing]
+        Category.objects.bulk_create(new_categories, batch_size=self.batch_size)
+        category_lookup.remember({category.id: category.id for category in new_categories})
+        self.rows['categories'] += len(new_categories)
+
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id) for category_id in names],
+            batch_size=self.batch_size, ignore_conflicts=True)
+        self.timed('categories', started)
+
+    def delete_product_infos(self):
+        started = perf_counter()
+        self.delete_offers(ProductInfo.objects.filter(shop_id=self.shop.id))
+        self.timed('delete', started)
+
+    def delete_offers(self, product_infos):
+        '''delete offers, cascaded order lines change totals of their orders'''
+        with Order.deferred_totals():
+            self.rows['deleted'] += product_infos.delete()[1].get(ProductInfo._meta.label, 0)
+
+    def delete_stale_product_infos(self):
+        '''remove offers missing from the price list'''
+        started = perf_counter()
+        stale = [product_info_id for product_info_id, external_id in ProductInfo.objects.filter(
+            shop_id=self.shop.id).values_list('id', 'external_id').iterator()
+            if external_id not in self.seen_external_ids]
+        for ids in chunked(stale, self.batch_size):
+            self.delete_offers(ProductInfo.objects.filter(id__in=ids))
+        self.timed('delete', started)
+
+    def resolve_products(self, keys):
+        '''(name, category_id) -> product id'''
+        started = perf_counter()
+        product_ids = product_lookup.get_ids(keys)
+        new_products = [Product(name=name, category_id=category_id)
+                        for name, category_id in keys
+                        if (name, category_id) not in product_ids]
+        if new_products:
+            Product.objects.bulk_create(new_products, batch_size=self.batch_size)
+            self.rows['products'] += len(new_products)
+            if connection.features.can_return_rows_from_bulk_insert:
+                created = {(product.name, product.category_id): product.id
+                           for product in new_products}
+                product_lookup.remember(created)
+                product_ids.update(created)
+            else:
+                product_ids.update(product_lookup.get_ids(
+                    {(product.name, product.category_id) for product in new_products}))
+        self.timed('products', started)
+        return product_ids
+
+    def resolve_parameters(self, names):
+        '''name -> parameter id'''
+        started = perf_counter()
+        parameter_ids = parameter_lookup.get_ids(names)
+        new_parameters = [Parameter(name=name) for name in names
+                          if name not in parameter_ids]
+        if new_parameters:
+            Parameter.objects.bulk_create(new_parameters, batch_size=self.batch_size)
+            self.rows['parameters'] += len(new_parameters)
+            if connection.features.can_return_rows_from_bulk_insert:
+                created = {parameter.name: parameter.id for parameter in new_parameters}
+                parameter_lookup.remember(created)
+                parameter_ids.update(created)
+            else:
+                parameter_ids.update(parameter_lookup.get_ids(
+                    {parameter.name for parameter in new_parameters}))
+        self.timed('parameters', started)
+        return parameter_ids
+
+    def import_goods(self, goods):
+        product_ids = self.resolve_products({(item['name'], item['category']) for item in goods})
+        parameter_ids = self.resolve_parameters({name for item in goods
+                                                 for name in item['parameters']})
+
+        started = perf_counter()
+        existing = {}
+        if self.incremental:
+            existing = self.match_product_infos(
+                {item['id']: product_ids[(item['name'], item['category'])] for item in goods})
+
+        new_goods, new_product_infos = [], []
+        changed_goods, changed_product_infos = [], []
+        for item in goods:
+            item_hash = content_hash(item)
+            product_info_id, stored_hash = existing.get(item['id'], (None, None))
+            if stored_hash == item_hash:
+                self.rows['unchanged'] += 1
+                continue
+
+            product_info = ProductInfo(id=product_info_id,
+                                       product_id=product_ids[(item['name'], item['category'])],
+                                       external_id=item['id'],
+                                       model=item['model'],
+                                       price=item['price'],
+                                       price_rrc=item['price_rrc'],
+                                       quantity=item['quantity'],
+                                       content_hash=item_hash,
+                                       shop_id=self.shop.id)
+            if product_info_id is None:
+                new_goods.append(item)
+                new_product_infos.append(product_info)
+            else:
+                changed_goods.append(item)
+                changed_product_infos.append(product_info)
+
+        self.create_product_infos(new_product_infos)
+        ProductInfo.objects.bulk_update(changed_product_infos,
+                                        ('product', 'external_id', 'model', 'price',
+                                         'price_rrc', 'quantity', 'content_hash'),
+                                        batch_size=self.batch_size)
+        self.rows['product_infos'] += len(goods)
+        self.rows['created'] += len(new_product_infos)
+        self.rows['updated'] += len(changed_product_infos)
+        self.timed('product_infos', started)
+
+        started = perf_counter()
+        if changed_product_infos:
+            ProductParameter.objects.filter(
+                product_info_id__in=[product_info.id for product_info in changed_product_infos]
+            ).delete()
+        product_parameters = [
+            ProductParameter(product_info_id=product_info.id,
+                             parameter_id=parameter_ids[name],
+                             value=value)
+            for item, product_info in zip(new_goods + changed_goods,
+                                          new_product_infos + changed_product_infos)
+            for name, value in item['parameters'].items()]
+        ProductParameter.objects.bulk_create(product_parameters, batch_size=self.batch_size)
+        self.rows['product_parameters'] += len(product_parameters)
+        self.timed('product_parameters', started)
+
+        started = perf_counter()
+        refresh_catalog_entries([product_info.id for product_info
+                                 in new_product_infos + changed_product_infos],
+                                batch_size=self.batch_size)
+        self.timed('catalog', started)
+
+    def match_product_infos(self, item_products):
+        '''
+        Строки магазина для позиций пачки {external_id: product_id}:
+        external_id -> (id, content_hash). Строка ищется по товару, затем по
+        external_id, если ее товар не занят другой позицией пачки. Строки,
+        чей external_id перешел к другой позиции (обмен, сдвиг номеров),
+        освобождают его до записи пачки; не найденные позже удаляются как
+        устаревшие
+        '''
+        self.seen_external_ids.update(item_products)
+        rows = list(ProductInfo.objects.filter(shop_id=self.shop.id).filter(
+            Q(product_id__in=set(item_products.values()))
+            | Q(external_id__in=list(item_products))).values_list(
+            'id', 'product_id', 'external_id', 'content_hash'))
+        by_product = {row[1]: row for row in rows}
+        by_external_id = {row[2]: row for row in rows if row[2] in item_products}
+
+        matched = {external_id: by_product[product_id]
+                   for external_id, product_id in item_products.items()
+                   if product_id in by_product}
+        taken = {row[0] for row in matched.values()}
+        for external_id in item_products:
+            row = by_external_id.get(external_id)
+            if external_id not in matched and row is not None and row[0] not in taken:
+                matched[external_id] = row
+                taken.add(row[0])
+
+        displaced = [row[0] for external_id, row in by_external_id.items()
+                     if matched.get(external_id) is not row]
+        if displaced:
+            ProductInfo.objects.filter(id__in=displaced).update(external_id=None)
+        return {external_id: (row[0], row[3] if row[2] == external_id else None)
+                for external_id, row in matched.items()}
+
+    def create_product_infos(self, product_infos):
+        ProductInfo.objects.bulk_create(product_infos, batch_size=self.batch_size)
+        if product_infos and not connection.features.can_return_rows_from_bulk_insert:
+            ids = dict(ProductInfo.objects.filter(
+                shop_id=self.shop.id,
+                external_id__in=[product_info.external_id for product_info in product_infos]
+            ).values_list('external_id', 'id'))
+            for product_info in product_infos:
+                product_info.id = ids[product_info.external_id]
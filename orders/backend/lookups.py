@@ -0,0 +1,166 @@
+from threading import Lock
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import *
+
+
+__all__ = [
+    'LRUCache',
+    'NameLookup',
+    'category_lookup',
+    'parameter_lookup',
+    'product_lookup',
+    'lookup_stats',
+    'clear_lookups',
+]
+
+class LRUCache:
+    '''
+    Потокобезопасный LRU-кеш с счетчиками попаданий
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    self.data.move_to_end(key)
+                    found[key] = self.data[key]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many((key,)).get(key, default)
+
+    def set_many(self, mapping):
+        with self.lock:
+            for key, value in mapping.items():
+                self.data[key] = value
+                self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_values(self, value):
+        with self.lock:
+            for key in [key for key, cached in self.data.items() if cached == value]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+        }
+
+
+class NameLookup:
+    '''
+    Кеш ключ -> id и id -> name для справочников (Category, Parameter, Product).
+    Заполняется только после коммита транзакции, сбрасывается сигналами моделей
+    '''
+    def __init__(self, model, key_fields=('name',), maxsize=None):
+        self.model = model
+        self.key_fields = key_fields
+        maxsize = maxsize or settings.LOOKUP_CACHE_SIZE
+        self.ids = LRUCache(maxsize)
+        self.names = LRUCache(maxsize)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def make_key(self, values):
+        return values[0] if len(self.key_fields) == 1 else tuple(values)
+
+    def get_ids(self, keys):
+        '''key -> id of existing rows'''
+        keys = set(keys)
+        found = self.ids.get_many(keys)
+        missing = keys - found.keys()
+        if missing:
+            if len(self.key_fields) == 1:
+                lookup = {f'{self.key_fields[0]}__in': missing}
+            else:
+                lookup = {f'{field}__in': {key[index] for key in missing}
+                          for index, field in enumerate(self.key_fields)}
+            loaded = {}
+            for row in self.model.objects.filter(**lookup).order_by(
+                    '-id').values_list('id', *self.key_fields):
+                key = self.make_key(row[1:])
+                if key in missing:
+                    loaded[key] = row[0]
+            found.update(loaded)
+            self.remember(loaded)
+        return found
+
+    def get_names(self, ids):
+        '''id -> name'''
+        ids = set(ids)
+        found = self.names.get_many(ids)
+        missing = ids - found.keys()
+        if missing:
+            loaded = dict(self.model.objects.filter(id__in=missing).values_list('id', 'name'))
+            found.update(loaded)
+            transaction.on_commit(lambda: self.names.set_many(loaded))
+        return found
+
+    def get_name(self, object_id):
+        return self.get_names((object_id,)).get(object_id)
+
+    def remember(self, mapping):
+        '''cache key -> id once the current transaction commits'''
+        if mapping:
+            transaction.on_commit(lambda: self.ids.set_many(mapping))
+
+    def invalidate(self, object_id):
+        self.ids.delete_values(object_id)
+        self.names.delete(object_id)
+
+    def clear(self):
+        self.ids.clear()
+        self.names.clear()
+
+    def stats(self):
+        return {'ids': self.ids.stats(), 'names': self.names.stats()}
+
+
+category_lookup = NameLookup(Category, ('id',))
+parameter_lookup = NameLookup(Parameter)
+product_lookup = NameLookup(Product, ('name', 'category_id'))
+
+
+def lookup_stats():
+    return {
+        'category': category_lookup.stats(),
+        'parameter': parameter_lookup.stats(),
+        'product': product_lookup.stats(),
+    }
+
+
+def clear_lookups():
+    category_lookup.clear()
+    parameter_lookup.clear()
+    product_lookup.clear()
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from backend.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run backend benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+
+    def handle(self, *args, **options):
+        BENCHMARKS[options['name']](options['rows'], self.stdout.write)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.models import ProductInfo, CatalogEntry
+from backend.catalog import refresh_catalog_entries, bump_catalog_version
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized catalog read model from ProductInfo'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            CatalogEntry.objects.all().delete()
+            refresh_catalog_entries(ProductInfo.objects.values_list('id', flat=True).iterator())
+            bump_catalog_version()
+        self.stdout.write(f'{CatalogEntry.objects.count()} catalog entries')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Recalculate stored order totals from order items'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            Order.update_totals(Order.objects.values('id'))
+        self.stdout.write(f'{Order.objects.count()} orders')
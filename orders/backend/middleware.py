@@ -0,0 +1,66 @@
+import brotli
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+
+__all__ = [
+    'CompressionMiddleware',
+]
+
+def accepted_encodings(request):
+    return {encoding.split(';')[0].strip().lower() for encoding
+            in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')}
+
+
+def brotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=settings.BROTLI_QUALITY)
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    '''
+    Сжатие ответов API: brotli или gzip,
+    потоковые ответы сжимаются по частям
+    '''
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '').split(';')[0].strip()
+        if content_type not in settings.COMPRESS_CONTENT_TYPES:
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESS_MIN_LENGTH:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encodings = accepted_encodings(request)
+        if 'br' in encodings:
+            encoding = 'br'
+        elif 'gzip' in encodings:
+            encoding = 'gzip'
+        else:
+            return response
+
+        if response.streaming:
+            response.streaming_content = (
+                brotli_sequence(response.streaming_content) if encoding == 'br'
+                else compress_sequence(response.streaming_content))
+            del response['Content-Length']
+        else:
+            compressed = (brotli.compress(response.content, quality=settings.BROTLI_QUALITY)
+                          if encoding == 'br' else compress_string(response.content))
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = f'W/{etag}'
+        response['Content-Encoding'] = encoding
+        return response
@@ -1,5 +1,11 @@
-from django.db import models
+from contextlib import contextmanager
+from threading import local
+
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
@@ -18,6 +24,9 @@ __all__ = [
     'ProductParameter',
     'Order',
     'OrderItem',
+    'ImportJob',
+    'CatalogEntry',
+    'OutboxMessage',
 ]
 
 USER_TYPE_CHOICES = (
@@ -35,6 +44,27 @@ STATUS_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+IMPORT_STATUS_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('failed', 'Ошибка'),
+)
+
+OUTBOX_STATUS_CHOICES = (
+    ('pending', 'Ожидает отправки'),
+    ('sent', 'Отправлено'),
+    ('failed', 'Ошибка'),
+)
+
+IMPORT_MODE_CHOICES = (
+    ('incremental', 'Изменения'),
+    ('replace', 'Полная замена'),
+)
+
+# order ids whose totals wait for the end of Order.deferred_totals()
+pending_totals = local()
+
 class UserManager(BaseUserManager):
     use_in_migrations = True
 
@@ -160,6 +190,17 @@ class Shop(models.Model):
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='Статус',
                                 default=True)
+    feed_etag = models.CharField(verbose_name='ETag прайса',
+                                 max_length=200,
+                                 blank=True)
+    feed_last_modified = models.CharField(verbose_name='Last-Modified прайса',
+                                          max_length=50,
+                                          blank=True)
+    feed_hash = models.CharField(verbose_name='Хеш прайса',
+                                 max_length=40,
+                                 blank=True)
+    feed_checked_at = models.DateTimeField(verbose_name='Время проверки прайса',
+                                           blank=True, null=True)
     
     class Meta:
         verbose_name = 'Магазин'
@@ -209,7 +250,12 @@ class ProductInfo(models.Model):
     quantity = models.PositiveIntegerField(verbose_name='Количество')
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
-    external_id = models.PositiveIntegerField(verbose_name='Внешний ID')
+    # NULL only inside an import, while the row waits for its renumbered id
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ID',
+                                              null=True)
+    content_hash = models.CharField(verbose_name='Хеш содержимого',
+                                    max_length=40,
+                                    blank=True)
     product = models.ForeignKey(Product, verbose_name='Продукт',
                                 related_name='product_infos',
                                 blank=True,
@@ -224,7 +270,9 @@ class ProductInfo(models.Model):
         verbose_name_plural = 'Список информации о продуктах'
         constraints = [
             models.UniqueConstraint(fields=['product', 'shop'],
-                                    name='unique_product_info')]
+                                    name='unique_product_info'),
+            models.UniqueConstraint(fields=['shop', 'external_id'],
+                                    name='unique_shop_external_id')]
 
     def __str__(self):
         return f'{self.shop.name} - {self.product.name}'
@@ -261,6 +309,10 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'],
                                     name='unique_product_parameter')]
+        indexes = [
+            models.Index(fields=['parameter', 'value', 'product_info'],
+                         name='product_parameter_value'),
+        ]
 
     def __str__(self):
         return f'{self.product_info.model} - {self.parameter.name}'
@@ -279,14 +331,64 @@ class Order(models.Model):
     status = models.CharField(verbose_name='Статус',
                               max_length=20,
                               choices=STATUS_CHOICES)
+    stock_reserved = models.BooleanField(verbose_name='Товар зарезервирован',
+                                         default=False)
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа',
+                                            default=0)
+    total_quantity = models.PositiveIntegerField(verbose_name='Количество товаров',
+                                                 default=0)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Заказы"
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['dt', 'id'], name='order_dt_id'),
+        ]
 
     def __str__(self):
         return f'{self.user} - {self.dt}'
+
+    @staticmethod
+    def update_totals(order_ids):
+        '''
+        Пересчитать total_sum/total_quantity заказов одним UPDATE
+        с подзапросами по их позициям
+        '''
+        items = OrderItem.objects.filter(order_id=OuterRef('pk')).order_by().values('order_id')
+        Order.objects.filter(id__in=order_ids).update(
+            total_sum=Coalesce(Subquery(items.annotate(
+                total=Sum('total_amount')).values('total')), Value(0)),
+            total_quantity=Coalesce(Subquery(items.annotate(
+                total=Sum('quantity')).values('total')), Value(0)))
+
+    @staticmethod
+    @contextmanager
+    def deferred_totals():
+        '''
+        Итоги заказов, чьи позиции удалены внутри блока, пересчитываются
+        одним UPDATE на выходе, а не по запросу на позицию; в полученный
+        set можно добавить и другие заказы
+        '''
+        if getattr(pending_totals, 'order_ids', None) is not None:
+            yield pending_totals.order_ids
+            return
+        pending_totals.order_ids = order_ids = set()
+        try:
+            yield order_ids
+        finally:
+            pending_totals.order_ids = None
+        if order_ids:
+            Order.update_totals(order_ids)
+
+    @staticmethod
+    def item_deleted(order_id):
+        '''totals after a line is deleted, deferred inside deferred_totals()'''
+        order_ids = getattr(pending_totals, 'order_ids', None)
+        if order_ids is None:
+            Order.update_totals([order_id])
+        else:
+            order_ids.add(order_id)
     
 
 class OrderItem(models.Model):
@@ -311,6 +413,9 @@ class OrderItem(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['order_id', 'product_info'],
                                     name='unique_order_item'),]
+        indexes = [
+            models.Index(fields=['product_info', 'order'], name='order_item_product_order'),
+        ]
 
     def __str__(self):
         return f'''Заказ: {self.order} | {self.product_info.model}.
@@ -319,4 +424,128 @@ class OrderItem(models.Model):
 
     def save(self, *args, **kwargs):
         self.total_amount = self.price * self.quantity
-        super(OrderItem, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(OrderItem, self).save(*args, **kwargs)
+            Order.update_totals([self.order_id])
+
+
+
+class ImportJob(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='import_jobs',
+                             blank=True, null=True,
+                             on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='import_jobs',
+                             blank=True, null=True,
+                             on_delete=models.CASCADE)
+    file = models.FileField(verbose_name='Прайс',
+                            upload_to='imports/',
+                            storage=FileSystemStorage(settings.STORAGE))
+    task_id = models.CharField(verbose_name='ID задачи',
+                               max_length=50,
+                               blank=True)
+    status = models.CharField(verbose_name='Статус',
+                              max_length=20,
+                              choices=IMPORT_STATUS_CHOICES,
+                              default='queued')
+    mode = models.CharField(verbose_name='Режим',
+                            max_length=20,
+                            choices=IMPORT_MODE_CHOICES,
+                            default='incremental')
+    phase = models.CharField(verbose_name='Этап',
+                             max_length=30,
+                             blank=True)
+    rows_processed = models.PositiveIntegerField(verbose_name='Обработано строк',
+                                                 default=0)
+    errors = models.TextField(verbose_name='Ошибки',
+                              blank=True)
+    report = models.JSONField(verbose_name='Отчет',
+                              blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='Время создания')
+    started_at = models.DateTimeField(verbose_name='Время начала',
+                                      blank=True, null=True)
+    finished_at = models.DateTimeField(verbose_name='Время окончания',
+                                       blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Импорт прайса'
+        verbose_name_plural = 'Импорт прайсов'
+        ordering = ('-id',)
+
+    def __str__(self):
+        return f'{self.shop} - {self.created_at} ({self.status})'
+
+
+
+class CatalogEntry(models.Model):
+    product_info = models.OneToOneField(ProductInfo, verbose_name='Информация о продукте',
+                                        primary_key=True,
+                                        related_name='catalog_entry',
+                                        on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='catalog_entries',
+                             on_delete=models.CASCADE)
+    shop_state = models.BooleanField(verbose_name='Статус магазина',
+                                     default=True)
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='catalog_entries',
+                                 on_delete=models.CASCADE)
+    category_name = models.CharField(verbose_name='Категория',
+                                     max_length=50)
+    product_name = models.CharField(verbose_name='Продукт',
+                                    max_length=50)
+    model = models.CharField(verbose_name='Модель',
+                             max_length=50)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    parameters = models.JSONField(verbose_name='Параметры',
+                                  default=list)
+    search_text = models.TextField(verbose_name='Значения параметров для поиска',
+                                   blank=True)
+
+    class Meta:
+        verbose_name = 'Товар каталога'
+        verbose_name_plural = 'Каталог товаров'
+        indexes = [
+            models.Index(fields=['price'], name='catalog_price'),
+            models.Index(fields=['quantity'], name='catalog_quantity'),
+            models.Index(fields=['category', 'price'], name='catalog_category_price'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_id} - {self.product_name}'
+
+
+class OutboxMessage(models.Model):
+    subject = models.CharField(verbose_name='Тема',
+                               max_length=200)
+    body = models.TextField(verbose_name='Текст')
+    to_email = models.EmailField(verbose_name='Получатель')
+    status = models.CharField(verbose_name='Статус',
+                              max_length=20,
+                              choices=OUTBOX_STATUS_CHOICES,
+                              default='pending')
+    attempts = models.PositiveIntegerField(verbose_name='Попыток отправки',
+                                           default=0)
+    last_error = models.TextField(verbose_name='Последняя ошибка',
+                                  blank=True)
+    available_at = models.DateTimeField(verbose_name='Отправить не раньше',
+                                        default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True,
+                                      verbose_name='Время создания')
+    sent_at = models.DateTimeField(verbose_name='Время отправки',
+                                   blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Письмо'
+        verbose_name_plural = 'Исходящие письма'
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='outbox_status_available'),
+        ]
+
+    def __str__(self):
+        return f'{self.to_email} - {self.subject} ({self.status})'
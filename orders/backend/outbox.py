@@ -0,0 +1,133 @@
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+from kombu.exceptions import KombuError
+
+from .models import *
+
+
+__all__ = [
+    'enqueue_email',
+    'enqueue_emails',
+    'drain_outbox_messages',
+]
+
+
+def enqueue_email(subject, body, to_email):
+    '''
+    Письмо в outbox в текущей транзакции; отправка запускается после
+    коммита, откат транзакции отменяет и письмо
+    '''
+    message = OutboxMessage.objects.create(subject=subject, body=body, to_email=to_email)
+    transaction.on_commit(dispatch_outbox)
+    return message
+
+
+def enqueue_emails(messages):
+    '''
+    Пачка писем [(subject, body, to_email)] одним INSERT, после коммита
+    запускается одна отправка на всю пачку
+    '''
+    OutboxMessage.objects.bulk_create([
+        OutboxMessage(subject=subject, body=body, to_email=to_email)
+        for subject, body, to_email in messages])
+    if messages:
+        transaction.on_commit(dispatch_outbox)
+
+
+def dispatch_outbox():
+    '''start a drain, a broker outage leaves messages for the periodic drain'''
+    from .tasks import drain_outbox
+
+    try:
+        drain_outbox.apply_async(retry=False)
+    except KombuError:
+        pass
+
+
+def claim_batch(batch_size):
+    '''
+    due messages of one batch, leased for OUTBOX_LEASE seconds so that
+    a parallel drain skips them and a crashed worker releases them
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(OutboxMessage.objects.select_for_update(skip_locked=True).filter(
+            status='pending', available_at__lte=now).order_by('id')[:batch_size])
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            available_at=now + timedelta(seconds=settings.OUTBOX_LEASE))
+    return messages
+
+
+def schedule_retry(message, error, now):
+    message.attempts += 1
+    message.last_error = f'{type(error).__name__}: {error}'
+    if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        message.status = 'failed'
+    else:
+        message.available_at = now + timedelta(
+            seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (message.attempts - 1))
+
+
+def send_batch(connection, messages):
+    '''
+    Отправить пачку по одному SMTP соединению; ошибка письма (ответ сервера,
+    неверный адрес) не разрывает соединение, обрыв - переоткрывает его
+    для следующего письма. Возвращает (отправленные, неотправленные)
+    '''
+    sent, failed = [], []
+    for index, message in enumerate(messages):
+        try:
+            if connection.connection is None:
+                connection.open()
+        except OSError as error:
+            failed.extend((message, error) for message in messages[index:])
+            break
+        try:
+            connection.send_messages([EmailMultiAlternatives(
+                message.subject, message.body, settings.EMAIL_HOST_USER, [message.to_email])])
+        except Exception as error:
+            # a bad address fails in sanitize_address with ValueError or TypeError,
+            # it must not take the rest of the batch and the sent rows with it
+            failed.append((message, error))
+            if isinstance(error, OSError) and not isinstance(
+                    error, (SMTPResponseException, SMTPRecipientsRefused)):
+                connection.close()
+        else:
+            sent.append(message)
+    return sent, failed
+
+
+def drain_outbox_messages(batch_size=None):
+    '''
+    Отправить все готовые к отправке письма пачками по OUTBOX_BATCH_SIZE
+    через одно SMTP соединение. Ошибка отправки откладывает письмо
+    с экспоненциальной задержкой, после OUTBOX_MAX_ATTEMPTS попыток - failed
+    '''
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    result = {'sent': 0, 'retry': 0, 'failed': 0}
+    connection = get_connection(fail_silently=False)
+    try:
+        while True:
+            messages = claim_batch(batch_size)
+            if not messages:
+                return result
+            sent, failed = send_batch(connection, messages)
+            now = timezone.now()
+            OutboxMessage.objects.filter(id__in=[message.id for message in sent]).update(
+                status='sent', sent_at=now, available_at=now)
+            for message, error in failed:
+                schedule_retry(message, error, now)
+                result['failed' if message.status == 'failed' else 'retry'] += 1
+            OutboxMessage.objects.bulk_update(
+                [message for message, _ in failed],
+                ('status', 'attempts', 'last_error', 'available_at'))
+            result['sent'] += len(sent)
+            if len(messages) < batch_size:
+                return result
+    finally:
+        connection.close()
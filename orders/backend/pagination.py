@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+__all__ = [
+    'KeysetPagination',
+    'OrderFeedPagination',
+    'SearchPagination',
+]
+
+def positive_int(value, strict=False, cutoff=None):
+    '''int query parameter, ValueError if negative or, when strict, zero'''
+    value = int(value)
+    if value < 0 or (strict and value == 0):
+        raise ValueError(f'Invalid value: {value}')
+    return min(value, cutoff) if cutoff is not None else value
+
+
+class KeysetPagination(CursorPagination):
+    '''
+    Постраничный вывод по курсору на первичном ключе: WHERE id < x LIMIT n
+    вместо OFFSET, поэтому дальние страницы не дороже первой
+    '''
+    ordering = '-pk'
+    page_size = settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.MAX_PAGE_SIZE
+
+
+class OrderFeedPagination(KeysetPagination):
+    '''
+    Курсор по дате заказа (индекс order_dt_id), заказы с одной датой
+    различаются смещением курсора
+    '''
+    ordering = ('-dt', '-id')
+
+
+class SearchPagination(BasePagination):
+    '''
+    Постраничный вывод ранжированной выдачи: LIMIT/OFFSET без COUNT,
+    глубина ограничена SEARCH_MAX_RESULTS
+    '''
+    page_size = settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    offset_query_param = 'offset'
+    max_page_size = settings.MAX_PAGE_SIZE
+
+    def get_page_size(self, request):
+        try:
+            return positive_int(request.query_params[self.page_size_query_param],
+                                strict=True, cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_offset(self, request):
+        try:
+            return positive_int(request.query_params[self.offset_query_param],
+                                cutoff=settings.SEARCH_MAX_RESULTS)
+        except (KeyError, ValueError):
+            return 0
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.offset = self.get_offset(request)
+        limit = min(self.page_size, settings.SEARCH_MAX_RESULTS - self.offset)
+        rows = list(queryset[self.offset:self.offset + limit + 1]) if limit > 0 else []
+        # nothing is served past SEARCH_MAX_RESULTS, so no link to an empty page
+        self.has_next = (len(rows) > limit
+                         and self.offset + limit < settings.SEARCH_MAX_RESULTS)
+        return rows[:limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.offset_query_param, self.offset + self.page_size)
+
+    def get_previous_link(self):
+        if self.offset <= 0:
+            return None
+        url = self.request.build_absolute_uri()
+        offset = self.offset - self.page_size
+        if offset <= 0:
+            return remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.offset_query_param, offset)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return CursorPagination().get_paginated_response_schema(schema)
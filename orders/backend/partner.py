@@ -0,0 +1,80 @@
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import *
+from .models import STATUS_CHOICES
+
+
+__all__ = [
+    'parse_order_filters',
+    'shop_orders',
+    'shop_order_items',
+    'shop_order_page',
+]
+
+FEED_STATUSES = {status for status, _ in STATUS_CHOICES} - {'basket'}
+
+
+def parse_dt(value, name, end=False):
+    '''ISO datetime or date, a date as dt_to means up to the end of that day'''
+    try:
+        dt = parse_datetime(value)
+        if dt is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError
+            dt = datetime.combine(day, time.max if end else time.min)
+    except ValueError:
+        raise ValueError(f'Invalid {name}')
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+def parse_order_filters(params):
+    '''
+    Фильтры ленты заказов магазина: status=new,confirmed, dt_from, dt_to
+    (дата или дата и время ISO 8601)
+    '''
+    filters = {}
+    if params.get('status'):
+        statuses = {status.strip() for status in params['status'].split(',') if status.strip()}
+        if not statuses <= FEED_STATUSES:
+            raise ValueError(f'Invalid status: {", ".join(sorted(statuses - FEED_STATUSES))}')
+        filters['statuses'] = statuses
+    if params.get('dt_from'):
+        filters['dt_from'] = parse_dt(params['dt_from'], 'dt_from')
+    if params.get('dt_to'):
+        filters['dt_to'] = parse_dt(params['dt_to'], 'dt_to', end=True)
+    return filters
+
+
+def shop_orders(user_id, filters):
+    '''
+    Заказы с товарами магазина владельца user_id: ProductInfo.shop ->
+    OrderItem (индекс order_item_product_order) -> Order
+    '''
+    orders = Order.objects.filter(id__in=OrderItem.objects.filter(
+        product_info__shop__user_id=user_id).values('order_id')).exclude(status='basket')
+    if 'statuses' in filters:
+        orders = orders.filter(status__in=filters['statuses'])
+    if 'dt_from' in filters:
+        orders = orders.filter(dt__gte=filters['dt_from'])
+    if 'dt_to' in filters:
+        orders = orders.filter(dt__lte=filters['dt_to'])
+    return orders
+
+
+def shop_order_items(user_id):
+    '''order lines of the shop owned by user_id'''
+    return OrderItem.objects.filter(product_info__shop__user_id=user_id)
+
+
+def shop_order_page(rows):
+    '''
+    orders of a page (dicts with id from the paginator) in page order,
+    the shop lines come from shop_order_items via the serializer context
+    '''
+    return Order.objects.filter(id__in=[row['id'] for row in rows]).order_by('-dt', '-id')
@@ -0,0 +1,79 @@
+from yaml import SafeLoader
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.resolver import Resolver
+from yaml.events import MappingStartEvent, MappingEndEvent, SequenceStartEvent, SequenceEndEvent
+
+try:
+    from yaml.cyaml import CParser
+except ImportError:
+    CParser = None
+
+
+__all__ = [
+    'read_price_list',
+    'iter_price_list',
+]
+
+SEQUENCE_ITEMS = {
+    'categories': 'category',
+    'goods': 'good',
+}
+
+if CParser is not None:
+    class StreamLoader(CParser, Composer, SafeConstructor, Resolver):
+        '''
+        События libyaml + сборка узлов SafeLoader
+        '''
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+else:
+    StreamLoader = SafeLoader
+
+
+def iter_price_list(data):
+    '''
+    (kind, value) events of an already parsed price list
+    '''
+    yield 'shop', data['shop']
+    for category in data['categories']:
+        yield 'category', category
+    for item in data['goods']:
+        yield 'good', item
+
+
+def read_price_list(source):
+    '''
+    Потоковое чтение прайса: yaml разбирается по одному элементу
+    categories/goods, поэтому память не зависит от размера файла
+    '''
+    if isinstance(source, (str, bytes)) or hasattr(source, '__fspath__'):
+        with open(source, 'rb') as stream:
+            yield from read_price_list(stream)
+        return
+
+    loader = StreamLoader(source)
+    try:
+        loader.get_event()
+        loader.get_event()
+        if not loader.check_event(MappingStartEvent):
+            raise ValueError('Price list must be a mapping')
+        loader.get_event()
+
+        while not loader.check_event(MappingEndEvent):
+            key = loader.construct_document(loader.compose_node(None, None))
+            kind = SEQUENCE_ITEMS.get(key)
+            if kind and loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                index = 0
+                while not loader.check_event(SequenceEndEvent):
+                    yield kind, loader.construct_document(loader.compose_node(None, index))
+                    index += 1
+                loader.get_event()
+            else:
+                yield key, loader.construct_document(loader.compose_node(None, None))
+    finally:
+        loader.dispose()
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import renderers
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+import msgpack
+from ujson import dumps
+
+
+__all__ = [
+    'UJSONRenderer',
+    'MessagePackRenderer',
+    'ListResponse',
+]
+
+encoder = JSONEncoder()
+
+
+class UJSONRenderer(renderers.JSONRenderer):
+    '''
+    JSON через ujson: компактный вывод как у JSONRenderer, быстрее кодирование
+    '''
+    def dumps(self, data):
+        return dumps(data, ensure_ascii=False, escape_forward_slashes=False,
+                     default=encoder.default)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return self.dumps(data).encode()
+
+    def render_chunks(self, data, chunk_size):
+        '''same bytes as render() of a list, chunk_size items at a time'''
+        yield b'['
+        for start in range(0, len(data), chunk_size):
+            chunk = ','.join(self.dumps(item) for item in data[start:start + chunk_size])
+            yield (chunk if start == 0 else f',{chunk}').encode()
+        yield b']'
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    '''
+    MessagePack (Accept: application/msgpack)
+    '''
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encoder.default)
+
+    def render_chunks(self, data, chunk_size):
+        packer = msgpack.Packer(default=encoder.default)
+        yield packer.pack_array_header(len(data))
+        for start in range(0, len(data), chunk_size):
+            yield b''.join(packer.pack(item) for item in data[start:start + chunk_size])
+
+
+class ListResponse(Response):
+    '''
+    Response для списков: длинный список (больше STREAM_CHUNK_SIZE элементов)
+    отдается потоком по частям вместо одной строки
+    '''
+    def render(self):
+        renderer = getattr(self, 'accepted_renderer', None)
+        if (self._is_rendered or not isinstance(self.data, list)
+                or len(self.data) <= settings.STREAM_CHUNK_SIZE
+                or not hasattr(renderer, 'render_chunks')):
+            return super().render()
+
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f'{content_type}; charset={renderer.charset}'
+        response = StreamingHttpResponse(
+            renderer.render_chunks(self.data, settings.STREAM_CHUNK_SIZE),
+            status=self.status_code, content_type=content_type)
+        for header, value in self.items():
+            if header.lower() != 'content-type':
+                response[header] = value
+        response.cookies = self.cookies
+        return response
@@ -0,0 +1,151 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+
+from .models import *
+from .catalog import bump_catalog_version
+
+
+__all__ = [
+    'reserve_order',
+    'release_order',
+    'return_stock',
+]
+
+def by_id(quantities, field='id'):
+    '''CASE field WHEN product_info_id THEN quantity'''
+    return Case(*[When(**{field: product_info_id}, then=Value(quantity))
+                  for product_info_id, quantity in quantities.items()],
+                output_field=IntegerField())
+
+
+def apply_stock(shop_id, deltas):
+    '''add deltas {product_info_id: delta} to offers and catalog entries of one shop'''
+    ProductInfo.objects.filter(id__in=deltas).update(
+        quantity=F('quantity') + by_id(deltas))
+    CatalogEntry.objects.filter(product_info_id__in=deltas).update(
+        quantity=F('quantity') + by_id(deltas, 'product_info_id'))
+    bump_catalog_version(shop_id)
+
+
+def take_stock(shop_id, quantities):
+    '''
+    Одно условное UPDATE на магазин: списывается все или ничего,
+    True если хватило остатка по всем позициям
+    '''
+    requested = by_id(quantities)
+    condition = Q()
+    for product_info_id, quantity in quantities.items():
+        condition |= Q(id=product_info_id, quantity__gte=quantity)
+    updated = ProductInfo.objects.filter(condition, shop_id=shop_id).update(
+        quantity=F('quantity') - requested)
+    if updated != len(quantities):
+        return False
+    CatalogEntry.objects.filter(product_info_id__in=quantities).update(
+        quantity=F('quantity') - by_id(quantities, 'product_info_id'))
+    bump_catalog_version(shop_id)
+    return True
+
+
+def available_stock(quantities):
+    '''how much of each requested quantity is in stock now, without locking'''
+    available = dict(ProductInfo.objects.filter(id__in=quantities).values_list('id', 'quantity'))
+    return {product_info_id: min(quantity, available.get(product_info_id, 0))
+            for product_info_id, quantity in quantities.items()}
+
+
+def take_available(shop_id, quantities):
+    '''
+    Частичное списание для магазина, где остатка не хватило: строки
+    блокируются по порядку id, берется сколько есть
+    '''
+    available = dict(ProductInfo.objects.select_for_update().filter(
+        id__in=quantities).order_by('id').values_list('id', 'quantity'))
+    reserved = {product_info_id: min(quantity, available.get(product_info_id, 0))
+                for product_info_id, quantity in quantities.items()}
+    taken = {product_info_id: -quantity for product_info_id, quantity in reserved.items()
+             if quantity}
+    if taken:
+        apply_stock(shop_id, taken)
+    return reserved
+
+
+def reserve_order(order_id, partial=False):
+    '''
+    Резерв остатков под заказ: одно условное UPDATE F('quantity') на магазин.
+    Без partial заказ отклоняется, если не хватает хотя бы одной позиции,
+    с partial недостающие позиции уменьшаются или удаляются, повторный
+    вызов ничего не списывает. Возвращает {'status': reserved | partial | rejected, 'lines': [...]}
+    '''
+    with transaction.atomic():
+        # write first: claims the order once and takes the write lock before any read
+        if not Order.objects.filter(id=order_id, stock_reserved=False).update(
+                stock_reserved=True):
+            return {'status': 'reserved', 'lines': []}
+        lines = list(OrderItem.objects.filter(order_id=order_id).values_list(
+            'id', 'product_info_id', 'product_info__shop_id', 'quantity', 'price'))
+        shops = {}
+        for _, product_info_id, shop_id, quantity, _ in lines:
+            shop_quantities = shops.setdefault(shop_id, {})
+            shop_quantities[product_info_id] = shop_quantities.get(product_info_id, 0) + quantity
+
+        reserved = {}
+        for shop_id, quantities in sorted(shops.items()):
+            with transaction.atomic():
+                taken = take_stock(shop_id, quantities)
+                if not taken:
+                    transaction.set_rollback(True)
+            if taken:
+                reserved.update(quantities)
+            elif partial:
+                reserved.update(take_available(shop_id, quantities))
+            else:
+                reserved.update(available_stock(quantities))
+
+        result = [{'id': line_id, 'product_info': product_info_id,
+                   'requested': quantity, 'reserved': reserved[product_info_id]}
+                  for line_id, product_info_id, _, quantity, _ in lines]
+        short = [line for line in result if line['reserved'] < line['requested']]
+        if not lines or (short and not partial) or not any(line['reserved'] for line in result):
+            transaction.set_rollback(True)
+            return {'status': 'rejected', 'lines': result}
+
+        with Order.deferred_totals() as order_ids:
+            for line_id, product_info_id, _, quantity, price in lines:
+                if reserved[product_info_id] == quantity:
+                    continue
+                if reserved[product_info_id]:
+                    OrderItem.objects.filter(id=line_id).update(
+                        quantity=reserved[product_info_id],
+                        total_amount=price * reserved[product_info_id])
+                    order_ids.add(order_id)
+                else:
+                    OrderItem.objects.filter(id=line_id).delete()
+        return {'status': 'partial' if short else 'reserved', 'lines': result}
+
+
+def return_stock(order_ids):
+    '''put quantities of the order lines back in stock, one UPDATE per shop'''
+    shops = {}
+    for product_info_id, shop_id, quantity in OrderItem.objects.filter(
+            order_id__in=order_ids).values_list('product_info_id', 'product_info__shop_id',
+                                                'quantity'):
+        shop_quantities = shops.setdefault(shop_id, {})
+        shop_quantities[product_info_id] = shop_quantities.get(product_info_id, 0) + quantity
+    for shop_id, quantities in sorted(shops.items()):
+        apply_stock(shop_id, quantities)
+
+
+def release_order(order_id, status='canceled', sources=None):
+    '''
+    Вернуть зарезервированный товар на склад (одно UPDATE на магазин);
+    повторный вызов ничего не делает. sources - статусы, из которых заказ
+    можно перевести, проверяются тем же UPDATE
+    '''
+    orders = Order.objects.filter(id=order_id, stock_reserved=True)
+    if sources is not None:
+        orders = orders.filter(status__in=sources)
+    with transaction.atomic():
+        if not orders.update(stock_reserved=False, status=status):
+            return False
+        return_stock([order_id])
+        return True
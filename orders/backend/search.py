@@ -0,0 +1,100 @@
+import re
+
+from django.db import connections
+from django.db.models import Q
+
+from .models import CatalogEntry
+
+
+__all__ = [
+    'create_search_index',
+    'search_catalog',
+]
+
+TABLE = CatalogEntry._meta.db_table
+FTS_TABLE = f'{TABLE}_fts'
+TOKEN = re.compile(r'\w+')
+
+SQLITE_INDEX = [
+    f'''CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        product_name, model, search_text,
+        content='{TABLE}', content_rowid='product_info_id')''',
+    f'''CREATE TRIGGER IF NOT EXISTS {TABLE}_ai AFTER INSERT ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, product_name, model, search_text)
+        VALUES (new.product_info_id, new.product_name, new.model, new.search_text);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {TABLE}_ad AFTER DELETE ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, product_name, model, search_text)
+        VALUES ('delete', old.product_info_id, old.product_name, old.model, old.search_text);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {TABLE}_au AFTER UPDATE OF product_name, model, search_text
+        ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, product_name, model, search_text)
+        VALUES ('delete', old.product_info_id, old.product_name, old.model, old.search_text);
+        INSERT INTO {FTS_TABLE}(rowid, product_name, model, search_text)
+        VALUES (new.product_info_id, new.product_name, new.model, new.search_text);
+    END''',
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+POSTGRES_VECTOR = ("setweight(to_tsvector('simple', product_name), 'A') || "
+                   "setweight(to_tsvector('simple', model), 'B') || "
+                   "setweight(to_tsvector('simple', search_text), 'C')")
+
+POSTGRES_INDEX = [
+    f'CREATE INDEX IF NOT EXISTS {TABLE}_search ON {TABLE} USING gin (({POSTGRES_VECTOR}))',
+]
+
+
+def create_search_index(using='default', **kwargs):
+    '''
+    post_migrate: FTS5 с триггерами для SQLite, GIN по tsvector для PostgreSQL
+    '''
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            if FTS_TABLE in connection.introspection.table_names(cursor):
+                return
+            for statement in SQLITE_INDEX:
+                cursor.execute(statement)
+        elif connection.vendor == 'postgresql':
+            for statement in POSTGRES_INDEX:
+                cursor.execute(statement)
+
+
+def search_catalog(queryset, query):
+    '''
+    Ранжированный поиск по названию, модели и значениям параметров;
+    остальные фильтры queryset сохраняются
+    '''
+    tokens = TOKEN.findall(query)
+    if not tokens:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'sqlite':
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        # product_info_id unqualified: the table is relabeled when used as a subquery
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.rowid = product_info_id',
+                   f'{FTS_TABLE} MATCH %s'],
+            params=[match],
+            select={'rank': f'bm25({FTS_TABLE}, 10.0, 5.0, 1.0)'},
+            order_by=['rank', '-pk'])
+
+    if vendor == 'postgresql':
+        tsquery = "to_tsquery('simple', %s)"
+        match = ' & '.join(f'{token}:*' for token in tokens)
+        return queryset.extra(
+            where=[f'({POSTGRES_VECTOR}) @@ {tsquery}'],
+            params=[match],
+            select={'rank': f'ts_rank({POSTGRES_VECTOR}, {tsquery})'},
+            select_params=[match],
+            order_by=['-rank', '-pk'])
+
+    for token in tokens:
+        queryset = queryset.filter(
+            Q(product_name__icontains=token) | Q(model__icontains=token) |
+            Q(search_text__icontains=token))
+    return queryset.order_by('-pk')
@@ -1,6 +1,11 @@
+from django.db.models import QuerySet
+from django.utils import timezone
 from rest_framework import serializers
 
 from .models import *
+from .models import STATUS_CHOICES
+from .lookups import category_lookup, parameter_lookup
+from .fieldsets import *
 
 
 __all__ = [
@@ -14,8 +19,208 @@ __all__ = [
     'OrderItemSerializer',
     'OrderItemCreateSerializer',
     'OrderSerializer',
+    'BasketItemSerializer',
+    'BasketQuantitySerializer',
+    'OrderStatusSerializer',
+    'ImportJobSerializer',
+    'CatalogEntrySerializer',
+    'ProductInfoListSerializer',
+    'OrderListSerializer',
+    'CatalogEntryListSerializer',
+    'product_info_rows',
 ]
 
+class CachedNameField(serializers.Field):
+    '''
+    Имя связанного объекта по <field>_id из кеша справочника, без join
+    '''
+    def __init__(self, lookup, **kwargs):
+        self.lookup = lookup
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        return getattr(instance, f'{self.source}_id')
+
+    def to_representation(self, value):
+        return self.lookup.get_name(value)
+
+
+def product_info_rows(queryset, fieldset=None, prefix=''):
+    '''
+    ProductInfoSerializer representation of queryset rows from plain tuples:
+    one query for offers, one for parameters, names from lookup caches.
+    Parts the fieldset does not want are left out of the queries
+    '''
+    fieldset = fieldset or Fieldset(PRODUCT_INFO_FIELDS, PRODUCT_INFO_EXPANDABLE)
+    with_product = fieldset.wants(f'{prefix}product')
+    with_category = fieldset.wants(f'{prefix}product.category')
+    with_parameters = (fieldset.wants(f'{prefix}product_parameters')
+                       and fieldset.expanded(f'{prefix}product_parameters'))
+
+    columns = ['id', 'model', 'shop_id', 'quantity', 'price', 'price_rrc']
+    if with_product:
+        columns += ['product__name', 'product__category_id']
+    rows = list(queryset.prefetch_related(None).values_list(*columns))
+    if not rows:
+        return []
+
+    parameters = {}
+    if with_parameters:
+        parameter_rows = list(ProductParameter.objects.filter(
+            product_info__in=[row[0] for row in rows]).values_list(
+            'product_info_id', 'parameter_id', 'value'))
+        parameter_names = parameter_lookup.get_names({row[1] for row in parameter_rows})
+        for product_info_id, parameter_id, value in parameter_rows:
+            parameters.setdefault(product_info_id, []).append(
+                {'parameter': parameter_names.get(parameter_id), 'value': value})
+    category_names = (category_lookup.get_names({row[7] for row in rows})
+                      if with_category else {})
+
+    return [{
+        'id': row[0],
+        'model': row[1],
+        'product': {'name': row[6], 'category': category_names.get(row[7])}
+                   if with_product else None,
+        'shop': row[2],
+        'quantity': row[3],
+        'price': row[4],
+        'price_rrc': row[5],
+        'product_parameters': parameters.get(row[0], []),
+    } for row in rows]
+
+
+class ProductInfoListSerializer(serializers.ListSerializer):
+    '''
+    Быстрый вывод списка ProductInfo через values_list
+    '''
+    def to_representation(self, data):
+        fieldset = self.context.get('fieldset')
+        if not isinstance(data, QuerySet):
+            rows = super().to_representation(data)
+        else:
+            rows = product_info_rows(data, fieldset)
+        return fieldset.apply(rows) if fieldset else rows
+
+
+class OrderListSerializer(serializers.ListSerializer):
+    '''
+    Быстрый вывод списка заказов через values_list; context['ordered_items'] -
+    queryset позиций вместо всех позиций заказа, с context['line_totals']
+    total_sum считается только по этим позициям
+    '''
+    def to_representation(self, data):
+        fieldset = self.context.get('fieldset') or Fieldset(ORDER_FIELDS, ORDER_EXPANDABLE)
+        if not isinstance(data, QuerySet):
+            return fieldset.apply(super().to_representation(data))
+
+        items = self.context.get('ordered_items', OrderItem.objects.all())
+        orders = list(data.prefetch_related(None).values_list(
+            'id', 'status', 'dt', 'contact_id', 'total_sum'))
+        if not orders:
+            return []
+
+        ordered_items, line_totals = {}, None
+        if self.context.get('line_totals') and fieldset.wants('total_sum'):
+            line_totals = {}
+        if fieldset.wants('ordered_items') or line_totals is not None:
+            for item_id, order_id, product_info_id, quantity, total_amount in items.filter(
+                    order_id__in=[order[0] for order in orders]).values_list(
+                    'id', 'order_id', 'product_info_id', 'quantity', 'total_amount'):
+                ordered_items.setdefault(order_id, []).append(
+                    (item_id, product_info_id, quantity))
+                if line_totals is not None:
+                    line_totals[order_id] = line_totals.get(order_id, 0) + total_amount
+
+        product_infos = {}
+        if (fieldset.wants('ordered_items.product_info')
+                and fieldset.expanded('ordered_items.product_info')):
+            product_infos = {row['id']: row for row in product_info_rows(
+                ProductInfo.objects.filter(id__in={
+                    item[1] for order_items in ordered_items.values() for item in order_items}),
+                fieldset, 'ordered_items.product_info.')}
+        contacts = {}
+        if fieldset.wants('contact') and fieldset.expanded('contact'):
+            contacts = {row['id']: row for row in Contact.objects.filter(
+                id__in={order[3] for order in orders if order[3] is not None}).values(
+                'id', 'city', 'street', 'house', 'apartment', 'phone')}
+
+        dt = self.child.fields['dt']
+        rows = [{
+            'id': order[0],
+            'ordered_items': [{
+                'id': item_id,
+                'product_info': product_infos.get(product_info_id, product_info_id),
+                'quantity': quantity,
+            } for item_id, product_info_id, quantity in ordered_items.get(order[0], [])],
+            'status': order[1],
+            'dt': dt.to_representation(order[2]) if order[2] is not None else None,
+            'total_sum': order[4] if line_totals is None else line_totals.get(order[0], 0),
+            'contact': contacts.get(order[3], order[3]),
+        } for order in orders]
+        return fieldset.apply(rows)
+
+
+class CatalogEntryListSerializer(serializers.ListSerializer):
+    '''
+    Быстрый вывод страницы каталога без полей DRF; читаются только
+    запрошенные колонки, остальные можно отложить через only()
+    '''
+    attributes = (
+        ('id', 'product_info_id', 'product_info'),
+        ('model', 'model', 'model'),
+        ('product.name', 'product_name', 'product_name'),
+        ('product.category', 'category_name', 'category_name'),
+        ('shop', 'shop_id', 'shop'),
+        ('quantity', 'quantity', 'quantity'),
+        ('price', 'price', 'price'),
+        ('price_rrc', 'price_rrc', 'price_rrc'),
+        ('product_parameters', 'parameters', 'parameters'),
+    )
+
+    @classmethod
+    def selected(cls, fieldset):
+        return [(path, attname, field) for path, attname, field in cls.attributes
+                if fieldset.wants(path) and (path not in fieldset.expandable
+                                             or fieldset.expanded(path))]
+
+    @classmethod
+    def model_fields(cls, fieldset):
+        '''CatalogEntry fields to load for the fieldset'''
+        return [field for _, _, field in cls.selected(fieldset)]
+
+    def to_representation(self, data):
+        fieldset = (self.context.get('fieldset')
+                    or Fieldset(PRODUCT_INFO_FIELDS, PRODUCT_INFO_EXPANDABLE))
+        columns, product = [], []
+        for path, attname, _ in self.selected(fieldset):
+            if path.startswith('product.'):
+                if not product:
+                    columns.append(('product', None))
+                product.append((path[len('product.'):], attname))
+            else:
+                columns.append((path, attname))
+        # product_parameters.value and the like: subfields of each parameter
+        parameter_fields = (fieldset.selected or {}).get('product_parameters')
+        if parameter_fields is True:
+            parameter_fields = None
+
+        rows = []
+        for entry in data:
+            row = {}
+            for name, attname in columns:
+                if attname is None:
+                    row[name] = {key: getattr(entry, field) for key, field in product}
+                else:
+                    row[name] = getattr(entry, attname)
+            if parameter_fields is not None and 'product_parameters' in row:
+                row['product_parameters'] = [
+                    {key: value for key, value in parameter.items() if key in parameter_fields}
+                    for parameter in row['product_parameters']]
+            rows.append(row)
+        return rows
+
+
 class ContactSerializer(serializers.ModelSerializer):
     class Meta:
         model = Contact
@@ -53,7 +258,7 @@ class ShopSerializer(serializers.ModelSerializer):
 
 
 class ProductSerializer(serializers.ModelSerializer):
-    category = serializers.StringRelatedField()
+    category = CachedNameField(category_lookup)
 
     class Meta:
         model = Product
@@ -61,7 +266,7 @@ class ProductSerializer(serializers.ModelSerializer):
 
 
 class ProductParameterSerializer(serializers.ModelSerializer):
-    parameter = serializers.StringRelatedField()
+    parameter = CachedNameField(parameter_lookup)
 
     class Meta:
         model = ProductParameter
@@ -76,6 +281,7 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         model = ProductInfo
         fields = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_parameters',)
         read_only_fields = ('id',)
+        list_serializer_class = ProductInfoListSerializer
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
@@ -101,3 +307,56 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'ordered_items', 'status', 'dt', 'total_sum', 'contact',)
         read_only_fields = ('id',)
+        list_serializer_class = OrderListSerializer
+
+
+class BasketItemSerializer(serializers.Serializer):
+    product_info = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class BasketQuantitySerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class OrderStatusSerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1)
+    status = serializers.ChoiceField(choices=[choice for choice in STATUS_CHOICES
+                                              if choice[0] != 'basket'])
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    rate = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'status', 'mode', 'phase', 'rows_processed', 'rate', 'errors',
+                  'report', 'created_at', 'started_at', 'finished_at', 'file',)
+        read_only_fields = ('id', 'status', 'phase', 'rows_processed', 'errors',
+                            'report', 'created_at', 'started_at', 'finished_at',)
+        extra_kwargs = {
+            'file': {'write_only': True}
+        }
+
+    def get_rate(self, job):
+        if not job.started_at:
+            return None
+        elapsed = ((job.finished_at or timezone.now()) - job.started_at).total_seconds()
+        return round(job.rows_processed / elapsed) if elapsed > 0 else None
+
+
+class CatalogEntrySerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='product_info_id')
+    product = serializers.SerializerMethodField()
+    shop = serializers.IntegerField(source='shop_id')
+    product_parameters = serializers.JSONField(source='parameters')
+
+    class Meta:
+        model = CatalogEntry
+        fields = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_parameters',)
+        read_only_fields = fields
+        list_serializer_class = CatalogEntryListSerializer
+
+    def get_product(self, entry):
+        return {'name': entry.product_name, 'category': entry.category_name}
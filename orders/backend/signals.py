@@ -1,29 +1,123 @@
-from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
 
 from .models import *
+from .lookups import category_lookup, parameter_lookup, product_lookup
+from .catalog import bump_catalog_version, catalog_signals_paused, refresh_catalog_entries
+from .outbox import enqueue_email
+from .authentication import token_cache
 
 
 __all__ = [
     'new_user_registered_signal',
     'send_email',
+    'invalidate_lookups',
+    'catalog_changed',
+    'offer_changed',
+    'shop_saved',
+    'category_saved',
+    'product_saved',
+    'parameter_saved',
+    'token_changed',
+    'user_saved',
 ]
 
 def new_user_registered_signal(user_id):
     token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
-    msg = EmailMultiAlternatives(
-        f'Token for {token.user.email}',
-        token.key,
-        settings.EMAIL_HOST_USER,
-        [token.user.email]
-    )
-    msg.send()
+    enqueue_email(f'Token for {token.user.email}', token.key, token.user.email)
 
 def send_email(title, msg, to_email):
-    msg = EmailMultiAlternatives(
-        title,
-        msg,
-        settings.EMAIL_HOST_USER,
-        [to_email]
-    )
-    msg.send()
+    enqueue_email(title, msg, to_email)
+
+
+LOOKUPS = {
+    Category: category_lookup,
+    Parameter: parameter_lookup,
+    Product: product_lookup,
+}
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Parameter)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Parameter)
+@receiver(post_delete, sender=Product)
+def invalidate_lookups(sender, instance, **kwargs):
+    LOOKUPS[sender].invalidate(instance.id)
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Parameter)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Shop)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Parameter)
+@receiver(post_delete, sender=Product)
+def catalog_changed(sender, instance, **kwargs):
+    bump_catalog_version()
+
+@receiver(post_save, sender=ProductInfo)
+@receiver(post_save, sender=ProductParameter)
+def offer_changed(sender, instance, **kwargs):
+    if catalog_signals_paused():
+        return
+    if sender is ProductParameter:
+        instance = instance.product_info
+    refresh_catalog_entries([instance.id])
+    bump_catalog_version(instance.shop_id)
+
+@receiver(post_delete, sender=ProductInfo)
+def offer_deleted(sender, instance, **kwargs):
+    if catalog_signals_paused():
+        return
+    # a parameter deleted by the same cascade has rebuilt the entry
+    CatalogEntry.objects.filter(product_info_id=instance.id).delete()
+    bump_catalog_version(instance.shop_id)
+
+@receiver(post_delete, sender=ProductParameter)
+def offer_parameter_deleted(sender, instance, **kwargs):
+    if catalog_signals_paused():
+        return
+    refresh_catalog_entries([instance.product_info_id])
+    shop_id = ProductInfo.objects.filter(
+        id=instance.product_info_id).values_list('shop_id', flat=True).first()
+    if shop_id is not None:
+        bump_catalog_version(shop_id)
+
+
+@receiver(post_save, sender=Shop)
+def shop_saved(sender, instance, **kwargs):
+    CatalogEntry.objects.filter(shop_id=instance.id).exclude(
+        shop_state=instance.state).update(shop_state=instance.state)
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    CatalogEntry.objects.filter(category_id=instance.id).exclude(
+        category_name=instance.name).update(category_name=instance.name)
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    refresh_catalog_entries(instance.product_infos.values_list('id', flat=True))
+
+@receiver(post_save, sender=Parameter)
+def parameter_saved(sender, instance, **kwargs):
+    refresh_catalog_entries(instance.product_parameters.values_list('product_info_id', flat=True))
+
+
+@receiver(post_delete, sender=OrderItem)
+def order_item_deleted(sender, instance, **kwargs):
+    Order.item_deleted(instance.order_id)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    token_cache.invalidate([instance.key])
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    if not created:
+        token_cache.invalidate(Token.objects.filter(
+            user_id=instance.id).values_list('key', flat=True))
@@ -0,0 +1,121 @@
+from time import monotonic
+from threading import RLock
+
+from django.conf import settings
+from redis import Redis
+
+
+__all__ = [
+    'FakeRedis',
+    'get_redis',
+]
+
+class FakeRedis:
+    '''
+    Redis в памяти процесса для разработки и тестов (REDIS_URL = memory://)
+    '''
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = RLock()
+
+    def _alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    def get(self, key):
+        with self.lock:
+            return self.data[key] if self._alive(key) else None
+
+    def mget(self, keys, *args):
+        keys = [keys, *args] if isinstance(keys, str) else list(keys) + list(args)
+        with self.lock:
+            return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            if nx and self._alive(key):
+                return None
+            self.data[key] = self._encode(value)
+            self.expires.pop(key, None)
+            if ex is not None:
+                self.expire(key, ex)
+            return True
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self.get(key) or 0) + amount
+            self.data[key] = self._encode(value)
+            return value
+
+    def delete(self, *keys):
+        with self.lock:
+            deleted = 0
+            for key in keys:
+                if self._alive(key):
+                    del self.data[key]
+                    self.expires.pop(key, None)
+                    deleted += 1
+            return deleted
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if not self._alive(key):
+                return False
+            self.expires[key] = monotonic() + seconds
+            return True
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        with self.client.lock:
+            results = [getattr(self.client, name)(*args, **kwargs)
+                       for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+
+clients = {}
+
+def get_redis():
+    url = settings.REDIS_URL
+    if url not in clients:
+        if url.startswith('memory://'):
+            clients[url] = FakeRedis()
+        else:
+            clients[url] = Redis.from_url(url, socket_timeout=settings.REDIS_TIMEOUT,
+                                          socket_connect_timeout=settings.REDIS_TIMEOUT)
+    return clients[url]
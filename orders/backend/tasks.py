@@ -1,32 +1,99 @@
-from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
 
 from orders.celery import app
 from .models import *
+from .importer import PriceListImporter
+from .pricelist import read_price_list
+from .feeds import fetch_feeds
+from .lookups import clear_lookups
+from .outbox import *
 
 
 __all__ = [
     'new_user_registered',
     'send_email',
+    'drain_outbox',
+    'import_price_list',
+    'pull_price_lists',
 ]
 
 @app.task()
 def new_user_registered(user_id):
     token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
-    msg = EmailMultiAlternatives(
-        f'Token for {token.user.email}',
-        token.key,
-        settings.EMAIL_HOST_USER,
-        [token.user.email]
-    )
-    msg.send()
+    enqueue_email(f'Token for {token.user.email}', token.key, token.user.email)
 
 @app.task()
 def send_email(title, msg, to_email):
-    msg = EmailMultiAlternatives(
-        title,
-        msg,
-        settings.EMAIL_HOST_USER,
-        [to_email]
-    )
-    msg.send()
+    enqueue_email(title, msg, to_email)
+
+@app.task()
+def drain_outbox():
+    return drain_outbox_messages()
+
+@app.task(bind=True)
+def import_price_list(self, job_id):
+    job = ImportJob.objects.get(id=job_id)
+    job.status = 'running'
+    job.task_id = self.request.id or ''
+    job.started_at = timezone.now()
+    job.save(update_fields=('status', 'task_id', 'started_at'))
+
+    def progress(importer):
+        if not self.request.called_directly and not self.request.is_eager:
+            self.update_state(state='PROGRESS', meta={
+                'phase': importer.phase,
+                'rows_processed': importer.rows['product_infos'],
+            })
+
+    importer = PriceListImporter(user_id=job.user_id, shop=job.shop, progress=progress,
+                                 incremental=job.mode == 'incremental')
+    try:
+        with job.file.open('rb') as file:
+            report = importer.run_events(read_price_list(file))
+    except Exception as error:
+        job.status = 'failed'
+        job.phase = importer.phase
+        job.errors = f'{type(error).__name__}: {error}'
+        clear_lookups()
+        if job.shop_id:
+            Shop.objects.filter(id=job.shop_id).update(feed_etag='',
+                                                       feed_last_modified='',
+                                                       feed_hash='')
+    else:
+        job.status = 'done'
+        job.phase = 'done'
+        job.shop = importer.shop
+        job.report = report
+    job.rows_processed = importer.rows['product_infos']
+    job.finished_at = timezone.now()
+    # the report stays, the price list is not needed once the job is over
+    job.file.delete(save=False)
+    job.save()
+    return job.status
+
+@app.task()
+def pull_price_lists():
+    shops = Shop.objects.filter(state=True).exclude(url__isnull=True).exclude(url='')
+    results = fetch_feeds(list(shops))
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+        shop = result.shop
+        # UPDATE instead of save(): the feed state is not catalog data, a post_save
+        # would bump the catalog version and reset every ETag on each poll
+        feed = Shop.objects.filter(id=shop.id)
+        if result.status == 'failed':
+            feed.update(feed_checked_at=timezone.now())
+            continue
+
+        feed.update(feed_etag=result.etag, feed_last_modified=result.last_modified,
+                    feed_hash=result.content_hash, feed_checked_at=timezone.now())
+        if result.status == 'changed':
+            with open(result.path, 'rb') as file:
+                job = ImportJob.objects.create(user_id=shop.user_id, shop=shop,
+                                               file=File(file, name=f'{shop.id}.yaml'))
+            result.discard()
+            transaction.on_commit(lambda job_id=job.id: import_price_list.delay(job_id))
+    return statuses
@@ -3,6 +3,27 @@ from rest_framework.test import APIClient
 from .models import User
 
 
+@pytest.fixture(autouse=True)
+def no_silk(settings):
+    settings.MIDDLEWARE = [middleware for middleware in settings.MIDDLEWARE
+                           if not middleware.startswith('silk.')]
+
+@pytest.fixture(autouse=True)
+def memory_redis(settings):
+    from .store import get_redis
+
+    settings.REDIS_URL = 'memory://'
+    get_redis().flushdb()
+    return get_redis()
+
+@pytest.fixture(autouse=True)
+def empty_lookups():
+    from .lookups import clear_lookups
+    from .authentication import token_cache
+
+    clear_lookups()
+    token_cache.clear()
+
 @pytest.fixture
 def client():
     return APIClient()
@@ -30,3 +51,1054 @@ def user_login(client, user):
         }
     )
     assert response.status_code == 201
+
+def make_price_list(goods_count, shop='Связной', price=1000):
+    return {
+        'shop': shop,
+        'categories': [{'id': 224, 'name': 'Смартфоны'},
+                       {'id': 15, 'name': 'Аксессуары'}],
+        'goods': [{
+            'id': 1000 + i,
+            'category': 224 if i % 2 else 15,
+            'model': f'model/{i}',
+            'name': f'Товар {i}',
+            'price': price,
+            'price_rrc': price + 100,
+            'quantity': 10,
+            'parameters': {'Цвет': 'черный', 'Память (Гб)': 64 * (i % 4 + 1)},
+        } for i in range(goods_count)],
+    }
+
+@pytest.mark.django_db
+def test_import_price_list(user_shop):
+    from yaml import safe_load
+    from .importer import PriceListImporter
+    from .models import ProductInfo, ProductParameter
+
+    with open('../data/shop1.yaml', encoding='utf-8') as file:
+        data = safe_load(file)
+    report = PriceListImporter(user_id=user_shop.id).run(data)
+
+    assert report['rows']['product_infos'] == 4
+    assert report['rows']['parameters'] == 4
+    assert ProductInfo.objects.filter(shop__user=user_shop).count() == 4
+    assert ProductParameter.objects.count() == 16
+
+@pytest.mark.django_db
+def test_import_queries_do_not_grow_with_rows():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from .importer import PriceListImporter
+
+    counts = []
+    for goods_count in (10, 200):
+        user = User.objects.create_user(email=f'shop{goods_count}@shop.ru',
+                                        password='shop', username=f'shop{goods_count}',
+                                        type='shop')
+        with CaptureQueriesContext(connection) as queries:
+            PriceListImporter(user_id=user.id).run(make_price_list(goods_count))
+        counts.append(len(queries))
+    assert counts[1] <= counts[0]
+
+@pytest.mark.django_db
+def test_import_job(client, user_shop):
+    import os
+    from django.core.files.base import ContentFile
+    from .models import ImportJob
+    from .tasks import import_price_list
+
+    client.force_authenticate(user_shop)
+    with open('../data/shop1.yaml', 'rb') as file:
+        response = client.post('/api/shop/update/', data={'file_name': file})
+    job_id = response.json()['job']
+    assert ImportJob.objects.get(id=job_id).status == 'queued'
+    stored = ImportJob.objects.get(id=job_id).file.path
+
+    import_price_list(job_id)
+    status = client.get(f'/api/shop/update/{job_id}/').json()
+    assert status['status'] == 'done'
+    assert status['rows_processed'] == 4
+    assert status['errors'] == ''
+    # finished jobs, done or failed, keep no copy of the price list
+    assert not ImportJob.objects.get(id=job_id).file and not os.path.exists(stored)
+
+    job = ImportJob.objects.create(user=user_shop, file=ContentFile(b'goods: [', name='bad.yaml'))
+    stored = job.file.path
+    assert import_price_list(job.id) == 'failed'
+    assert not ImportJob.objects.get(id=job.id).file and not os.path.exists(stored)
+
+def test_read_price_list_memory_is_flat(tmp_path):
+    import tracemalloc
+    from collections import deque
+    from .benchmarks import write_price_list
+    from .pricelist import read_price_list
+
+    peaks = []
+    for goods_count in (100, 2000):
+        path = tmp_path / f'{goods_count}.yaml'
+        write_price_list(path, goods_count)
+        tracemalloc.start()
+        deque(read_price_list(path), maxlen=0)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < peaks[0] * 1.5
+
+@pytest.mark.django_db
+def test_import_price_list_stream(user_shop):
+    from yaml import safe_load
+    from .importer import PriceListImporter
+    from .pricelist import read_price_list, iter_price_list
+
+    with open('../data/shop1.yaml', 'rb') as file:
+        data = safe_load(file)
+    assert list(read_price_list('../data/shop1.yaml')) == list(iter_price_list(data))
+
+    report = PriceListImporter(user_id=user_shop.id, batch_size=3).run_events(
+        read_price_list('../data/shop1.yaml'))
+    assert report['rows']['product_infos'] == 4
+
+@pytest.mark.django_db
+def test_incremental_import_touches_changed_rows(user_shop):
+    from .importer import PriceListImporter
+    from .models import ProductInfo, OrderItem, Order
+
+    data = make_price_list(200)
+    PriceListImporter(user_id=user_shop.id).run(data)
+    kept = ProductInfo.objects.get(external_id=1000)
+    order = Order.objects.create(user=user_shop, status='new')
+    OrderItem.objects.create(order=order, product_info=kept, price=kept.price)
+
+    data['goods'][1]['price'] = 2000
+    data['goods'][2]['price'] = 3000
+    del data['goods'][3]
+    report = PriceListImporter(user_id=user_shop.id).run(data)
+
+    assert report['rows']['updated'] == 2
+    assert report['rows']['created'] == 0
+    assert report['rows']['deleted'] == 1
+    assert report['rows']['unchanged'] == 197
+    assert ProductInfo.objects.get(external_id=1000).id == kept.id
+    assert ProductInfo.objects.get(external_id=1002).price == 3000
+    assert ProductInfo.objects.get(external_id=1002).product_parameters.count() == 2
+    assert OrderItem.objects.filter(product_info=kept).exists()
+
+    # the supplier renumbers its offers, rows and order lines stay
+    for item in data['goods']:
+        item['id'] += 10000
+    report = PriceListImporter(user_id=user_shop.id).run(data)
+    assert (report['rows']['created'], report['rows']['deleted']) == (0, 0)
+    assert ProductInfo.objects.get(external_id=11000).id == kept.id
+    assert ProductInfo.objects.filter(external_id__lt=10000).count() == 0
+    assert OrderItem.objects.filter(product_info=kept).exists()
+
+@pytest.mark.django_db
+def test_incremental_import_swapped_and_shifted_ids(user_shop):
+    from .importer import PriceListImporter
+    from .models import ProductInfo
+
+    data = make_price_list(4)
+    PriceListImporter(user_id=user_shop.id).run(data)
+
+    def rows():
+        return dict(ProductInfo.objects.values_list('product__name', 'id'))
+
+    before = rows()
+    goods = data['goods']
+    goods[0]['id'], goods[1]['id'] = goods[1]['id'], goods[0]['id']
+    report = PriceListImporter(user_id=user_shop.id).run(data)
+    assert report['rows']['updated'] == 2 and report['rows']['deleted'] == 0
+    assert rows() == before
+    assert ProductInfo.objects.get(external_id=goods[0]['id']).product.name == goods[0]['name']
+
+    # every id moves to the next offer, the rows holding them come in later batches
+    for item in goods:
+        item['id'] += 1
+    report = PriceListImporter(user_id=user_shop.id, batch_size=1).run(data)
+    assert (report['rows']['created'], report['rows']['deleted']) == (0, 0)
+    assert rows() == before
+    assert sorted(ProductInfo.objects.values_list('external_id', flat=True)) == \
+        sorted(item['id'] for item in goods)
+
+    # an offer dropped together with a shift: its row is deleted, the others stay
+    dropped = goods.pop(0)
+    for item in goods:
+        item['id'] -= 1
+    report = PriceListImporter(user_id=user_shop.id, batch_size=1).run(data)
+    assert (report['rows']['created'], report['rows']['deleted']) == (0, 1)
+    assert rows() == {name: id for name, id in before.items() if name != dropped['name']}
+
+@pytest.fixture
+def feed_server():
+    from threading import Thread
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    with open('../data/shop1.yaml', 'rb') as file:
+        body = file.read()
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    server.requests_seen = requests_seen
+    yield server
+    server.shutdown()
+
+@pytest.mark.django_db
+def test_pull_price_lists(feed_server, user_shop, django_capture_on_commit_callbacks):
+    from .catalog import catalog_version
+    from .models import Shop, ImportJob
+    from .tasks import pull_price_lists
+
+    shop = Shop.objects.create(name='Связной', user=user_shop,
+                               url=f'http://127.0.0.1:{feed_server.server_port}/shop1.yaml')
+
+    assert pull_price_lists() == {'changed': 1}
+    version = catalog_version()
+    # a poll that finds nothing new keeps the catalog ETags
+    with django_capture_on_commit_callbacks(execute=True):
+        assert pull_price_lists() == {'not_modified': 1}
+    assert catalog_version() == version
+    assert feed_server.requests_seen == [None, '"v1"']
+    assert Shop.objects.get(id=shop.id).feed_etag == '"v1"'
+
+    job = ImportJob.objects.get(shop=shop)
+    assert job.status == 'queued'
+    job.file.delete()
+
+@pytest.mark.django_db(transaction=True)
+def test_lookup_cache(user_shop):
+    from .importer import PriceListImporter
+    from .lookups import parameter_lookup, clear_lookups
+    from .models import Parameter
+
+    clear_lookups()
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(10))
+    assert parameter_lookup.get_ids(['Цвет']).keys() == {'Цвет'}
+    assert parameter_lookup.stats()['ids']['hits'] == 1
+
+    parameter = Parameter.objects.get(name='Цвет')
+    parameter.name = 'Color'
+    parameter.save()
+    assert parameter_lookup.ids.get('Цвет') is None
+    assert parameter_lookup.get_name(parameter.id) == 'Color'
+    clear_lookups()
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_response_cache(client, user_shop, django_assert_num_queries,
+                                django_capture_on_commit_callbacks):
+    from .importer import PriceListImporter
+    from .models import ProductInfo
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(5))
+    first = client.get('/api/products/').json()
+    with django_assert_num_queries(0):
+        assert client.get('/api/products/').json() == first
+
+    with django_capture_on_commit_callbacks(execute=True):
+        ProductInfo.objects.get(id=first['results'][0]['id']).delete()
+    assert len(client.get('/api/products/').json()['results']) == 4
+
+    data = make_price_list(5)
+    data['goods'][0]['price'] = 5000
+    PriceListImporter(user_id=user_shop.id).run(data)
+    prices = [item['price'] for item in client.get('/api/products/').json()['results']]
+    assert 5000 in prices
+
+    client.force_authenticate(user_shop)
+    client.post('/api/shop/state/', data={'state': 'false'})
+    assert client.get('/api/products/').json()['results'] == []
+
+@pytest.mark.django_db
+def test_products_keyset_pagination(client, user_shop):
+    from .importer import PriceListImporter
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(7))
+    ids, url = [], '/api/products/?page_size=3&category_id=224'
+    while url:
+        page = client.get(url).json()
+        assert len(page['results']) <= 3
+        ids += [item['id'] for item in page['results']]
+        url = page['next']
+    assert len(ids) == 3 and ids == sorted(ids, reverse=True)
+
+    from rest_framework.request import Request
+    from rest_framework.test import APIRequestFactory
+    from .pagination import KeysetPagination
+
+    request = Request(APIRequestFactory().get('/api/products/', {'page_size': 10 ** 6}))
+    assert KeysetPagination().get_page_size(request) == KeysetPagination.max_page_size
+
+    from .pagination import SearchPagination
+
+    default, largest = SearchPagination.page_size, SearchPagination.max_page_size
+    for page_size, expected in (('7', 7), ('0', default), ('-3', default), ('abc', default),
+                                (str(10 ** 6), largest)):
+        request = Request(APIRequestFactory().get('/api/products/', {'page_size': page_size}))
+        assert SearchPagination().get_page_size(request) == expected
+
+@pytest.mark.django_db
+def test_catalog_read_model(client, user_shop, django_assert_num_queries):
+    from .importer import PriceListImporter
+    from .models import ProductInfo, CatalogEntry, Category
+    from .serializers import ProductInfoSerializer
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(6))
+    assert CatalogEntry.objects.count() == 6
+
+    legacy = ProductInfoSerializer(ProductInfo.objects.order_by('-id'), many=True).data
+    with django_assert_num_queries(2):
+        results = client.get('/api/products/').json()['results']
+    assert results == legacy
+
+    category = Category.objects.get(id=224)
+    category.name = 'Телефоны'
+    category.save()
+    assert {item['product']['category'] for item in
+            client.get('/api/products/?category_id=224').json()['results']} == {'Телефоны'}
+
+    product_info = ProductInfo.objects.order_by('id').first()
+    product_info.product_parameters.order_by('id').first().delete()
+    assert len(CatalogEntry.objects.get(product_info_id=product_info.id).parameters) == \
+        product_info.product_parameters.count()
+    product_info.delete()
+    assert CatalogEntry.objects.count() == 5
+    assert not CatalogEntry.objects.filter(product_info_id=product_info.id).exists()
+
+@pytest.mark.django_db
+def test_catalog_search(client, user_shop, settings):
+    from .importer import PriceListImporter
+
+    from yaml import safe_load
+    from django.db import connection
+    from .search import FTS_TABLE
+
+    assert FTS_TABLE in connection.introspection.table_names()
+    with open('../data/shop1.yaml', encoding='utf-8') as file:
+        PriceListImporter(user_id=user_shop.id).run(safe_load(file))
+
+    results = client.get('/api/products/?q=iphone xr').json()['results']
+    assert {item['model'] for item in results} == {'apple/iphone/xr'}
+    assert len(results) == 3
+
+    results = client.get('/api/products/?q=красн').json()['results']
+    assert [item['product']['name'] for item in results] == ['Смартфон Apple iPhone XR 256GB (красный)']
+
+    page = client.get('/api/products/?q=apple&page_size=2').json()
+    assert len(page['results']) == 2 and page['next']
+    assert len(client.get(page['next']).json()['results']) == 2
+    assert client.get('/api/products/?q=nokia').json()['results'] == []
+
+    settings.SEARCH_MAX_RESULTS = 3
+    pages, url = [], '/api/products/?q=apple&page_size=1'
+    while url:
+        page = client.get(url).json()
+        pages.append(len(page['results']))
+        url = page['next']
+    assert pages == [1, 1, 1]
+
+@pytest.mark.django_db
+def test_catalog_facets(client, user_shop, django_assert_num_queries):
+    from .importer import PriceListImporter
+    from .models import CatalogEntry
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(8))
+    CatalogEntry.objects.filter(model='model/0').update(quantity=0)
+
+    with django_assert_num_queries(2):
+        data = client.get('/api/products/').json()
+    assert data['facets'] == {'Память (Гб)': {'128': 2, '192': 2, '256': 2, '64': 2},
+                              'Цвет': {'черный': 8}}
+
+    data = client.get('/api/products/?param=Память (Гб):64&param=Память (Гб):128'
+                      '&param=Цвет:черный&in_stock=true').json()
+    assert sorted(item['model'] for item in data['results']) == ['model/1', 'model/4', 'model/5']
+    assert data['facets']['Память (Гб)'] == {'128': 2, '64': 1}
+
+    data = client.get('/api/products/?price_min=1000&price_max=1000&q=товар').json()
+    assert len(data['results']) == 8 and data['facets']['Цвет'] == {'черный': 8}
+    assert client.get('/api/products/?param=Вес:1').json()['results'] == []
+    assert client.get('/api/products/?price_min=abc').json() == {'Error': 'Invalid price_min'}
+    assert client.get('/api/products/?param=Цвет').json() == {
+        'Error': 'Invalid param, expected Name:Value'}
+
+@pytest.mark.django_db
+def test_serializer_fast_path(client, user_shop):
+    from django.db.models import Prefetch
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.serializers import ListSerializer
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Order, OrderItem, Contact
+    from .serializers import ProductInfoSerializer, OrderSerializer
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(6))
+    product_infos = list(ProductInfo.objects.order_by('id'))
+    contact = Contact.objects.create(user=user_shop, city='Москва', phone='+7900')
+    for status, items in (('new', product_infos[:3]), ('sent', product_infos[3:]),
+                          ('basket', product_infos[1:2])):
+        order = Order.objects.create(user=user_shop, status=status,
+                                     contact=contact if status == 'new' else None)
+        for quantity, product_info in enumerate(items, 1):
+            OrderItem.objects.create(order=order, product_info=product_info,
+                                     quantity=quantity, price=product_info.price)
+
+    def assert_identical(serializer, queryset, context=None):
+        legacy = ListSerializer(queryset, child=serializer())
+        fast = serializer(queryset, many=True, context=context or {})
+        assert JSONRenderer().render(fast.data) == \
+            JSONRenderer().render(legacy.data)
+
+    assert_identical(ProductInfoSerializer, ProductInfo.objects.filter(price=1000))
+    assert_identical(OrderSerializer, Order.objects.exclude(status='basket').select_related(
+        'contact').prefetch_related('ordered_items'))
+    shop_items = OrderItem.objects.filter(product_info__in=product_infos[2:4])
+    assert_identical(OrderSerializer, Order.objects.prefetch_related(
+        Prefetch('ordered_items', shop_items)), {'ordered_items': shop_items})
+
+    client.force_authenticate(user_shop)
+    basket = client.get('/api/basket/').json()
+    assert [item['product_info']['id'] for item in basket[0]['ordered_items']] == \
+        [product_infos[1].id]
+    assert basket[0]['total_sum'] == 1000 and basket[0]['contact'] is None
+
+@pytest.mark.django_db
+def test_sparse_fieldsets(client, user_shop, django_assert_num_queries):
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Order, OrderItem, Contact
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(4))
+    product_info = ProductInfo.objects.order_by('id').first()
+    contact = Contact.objects.create(user=user_shop, city='Москва', phone='+7900')
+    order = Order.objects.create(user=user_shop, status='new', contact=contact)
+    OrderItem.objects.create(order=order, product_info=product_info, quantity=2, price=1000)
+
+    data = client.get('/api/products/?fields=id,product.name,price').json()
+    assert data['results'][0] == {'id': data['results'][0]['id'],
+                                  'product': {'name': 'Товар 3'}, 'price': 1000}
+    assert 'product_parameters' not in client.get(
+        '/api/products/?expand=').json()['results'][0]
+    assert client.get('/api/products/?fields=id,nope').json() == {'Error': 'Invalid field: nope'}
+    data = client.get('/api/products/?fields=id,product_parameters.value').json()
+    assert data['results'][0]['product_parameters'] == [{'value': 'черный'}, {'value': '256'}]
+
+    client.force_authenticate(user_shop)
+    with django_assert_num_queries(1):
+        orders = client.get('/api/orders/?fields=id,status').json()
+    assert orders == [{'id': order.id, 'status': 'new'}]
+
+    orders = client.get('/api/orders/?expand=contact').json()
+    assert orders[0]['contact']['city'] == 'Москва'
+    assert orders[0]['ordered_items'] == [{'id': order.ordered_items.get().id,
+                                           'product_info': product_info.id, 'quantity': 2}]
+
+    orders = client.get('/api/orders/?fields=ordered_items.product_info.price,total_sum'
+                        '&expand=').json()
+    assert orders == [{'ordered_items': [{'product_info': {'price': 1000}}], 'total_sum': 2000}]
+
+@pytest.mark.django_db
+def test_renderers_and_compression(client, user_shop, settings):
+    import gzip
+    import json
+    import brotli
+    import msgpack
+    from rest_framework.renderers import JSONRenderer
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Order, OrderItem
+    from .renderers import UJSONRenderer, MessagePackRenderer
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(6))
+    response = client.get('/api/products/', HTTP_ACCEPT='application/json')
+    assert response.content == JSONRenderer().render(response.data)
+    assert 'Content-Encoding' not in response
+
+    compressed = client.get('/api/products/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+    assert compressed['Content-Encoding'] == 'gzip'
+    assert compressed['Vary'].endswith('Accept-Encoding')
+    assert gzip.decompress(compressed.content) == response.content
+
+    data = [{'id': i, 'name': f'Товар/{i}'} for i in range(7)]
+    assert b''.join(UJSONRenderer().render_chunks(data, 3)) == UJSONRenderer().render(data)
+
+    settings.STREAM_CHUNK_SIZE = 2
+    for product_info in ProductInfo.objects.all():
+        order = Order.objects.create(user=user_shop, status='new')
+        OrderItem.objects.create(order=order, product_info=product_info, quantity=1, price=1000)
+    client.force_authenticate(user_shop)
+    streamed = client.get('/api/orders/', HTTP_ACCEPT_ENCODING='gzip')
+    assert streamed.streaming and streamed['Content-Encoding'] == 'gzip'
+    orders = b''.join(client.get('/api/orders/').streaming_content)
+    assert gzip.decompress(b''.join(streamed.streaming_content)) == orders
+    assert JSONRenderer().render(json.loads(orders)) == orders and len(json.loads(orders)) == 6
+
+    packed = client.get('/api/products/', HTTP_ACCEPT='application/msgpack')
+    assert msgpack.unpackb(packed.content) == response.json()
+    assert b''.join(MessagePackRenderer().render_chunks(data, 3)) == \
+        MessagePackRenderer().render(data)
+    streamed = client.get('/api/orders/', HTTP_ACCEPT='application/msgpack')
+    assert msgpack.unpackb(b''.join(streamed.streaming_content)) == json.loads(orders)
+
+    compressed = client.get('/api/products/', HTTP_ACCEPT_ENCODING='gzip, br')
+    assert compressed['Content-Encoding'] == 'br'
+    assert brotli.decompress(compressed.content) == response.content
+    streamed = client.get('/api/orders/', HTTP_ACCEPT_ENCODING='br')
+    assert streamed['Content-Encoding'] == 'br'
+    assert brotli.decompress(b''.join(streamed.streaming_content)) == orders
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_conditional_get(client, user_shop, django_assert_num_queries, monkeypatch):
+    from time import time
+    from . import catalog
+    from .importer import PriceListImporter
+
+    now = [int(time()) + 0.5]
+    monkeypatch.setattr(catalog, 'time', lambda: now[0])
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(4))
+    # the second of the last change is not over, a later change may share it
+    response = client.get('/api/products/')
+    assert 'Last-Modified' not in response
+    now[0] += 1
+    for url in ('/api/products/', '/api/categories/', '/api/shops/'):
+        response = client.get(url)
+        etag, modified = response['ETag'], response['Last-Modified']
+        assert etag.startswith('"') and 'Accept' in response['Vary']
+        with django_assert_num_queries(0):
+            not_modified = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert not_modified.status_code == 304 and not_modified['ETag'] == etag
+        assert client.get(url, HTTP_IF_MODIFIED_SINCE=modified).status_code == 304
+        assert client.get(url, HTTP_IF_MODIFIED_SINCE=modified,
+                          HTTP_IF_NONE_MATCH='"stale"').status_code == 200
+        assert client.get(f'{url}?page_size=1', HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    etag = client.get('/api/shops/')['ETag']
+    products_etag = client.get('/api/products/')['ETag']
+    client.force_authenticate(user_shop)
+    client.post('/api/shop/state/', data={'state': 'false'})
+    assert client.get('/api/shops/', HTTP_IF_NONE_MATCH=etag).status_code == 200
+    response = client.get('/api/products/', HTTP_IF_NONE_MATCH=products_etag)
+    assert response.status_code == 200 and response['ETag'] != products_etag
+
+@pytest.mark.django_db
+def test_basket_bulk_add(client, user_shop):
+    import json
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from .importer import PriceListImporter
+    from .models import ProductInfo, OrderItem
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(40))
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    client.force_authenticate(user_shop)
+
+    items = [{'product_info': ids[0], 'quantity': 2}, {'product_info': ids[1]},
+             {'product_info': ids[0], 'quantity': 1}, {'product_info': 0},
+             {'product_info': 10 ** 6}]
+    data = client.post('/api/basket/', {'items': json.dumps(items)}, format='json').json()
+    assert data['Objects created'] == 2 and data['Objects updated'] == 0
+    assert [item['status'] for item in data['items']] == [
+        'created', 'created', 'created', 'error', 'error']
+    assert data['items'][4]['errors'] == {'product_info': ['Product is not available']}
+    basket_item = OrderItem.objects.get(product_info_id=ids[0])
+    assert (basket_item.quantity, basket_item.total_amount) == (3, 3000)
+
+    data = client.post('/api/basket/', {'items': [{'product_info': ids[0]}]},
+                       format='json').json()
+    assert data['items'] == [{'product_info': ids[0], 'quantity': 1,
+                              'status': 'updated', 'id': basket_item.id}]
+    assert OrderItem.objects.get(id=basket_item.id).total_amount == 4000
+
+    counts = []
+    for batch in (ids[2:7], ids[7:37]):
+        with CaptureQueriesContext(connection) as context:
+            client.post('/api/basket/', {'items': [{'product_info': product_info_id}
+                                                   for product_info_id in batch]}, format='json')
+        counts.append(len(context))
+    assert counts[0] == counts[1]
+    assert client.post('/api/basket/', {'items': '{'}, format='json').json() == {
+        'Error': 'Invalid format request'}
+
+@pytest.mark.django_db
+def test_basket_bulk_update(client, user_shop, django_assert_num_queries):
+    from .importer import PriceListImporter
+    from .models import ProductInfo, OrderItem
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(3))
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    client.force_authenticate(user_shop)
+    lines = {item['product_info']: item['id'] for item in client.post(
+        '/api/basket/', {'items': [{'product_info': product_info_id} for product_info_id in ids]},
+        format='json').json()['items']}
+    ProductInfo.objects.filter(id=ids[0]).update(price=1500)
+
+    items = [{'id': lines[ids[0]], 'quantity': 4}, {'id': lines[ids[1]], 'quantity': 2},
+             {'id': lines[ids[2]], 'quantity': 0}]
+    # basket, update of lines, update of order totals, summary + savepoint pair
+    with django_assert_num_queries(6):
+        data = client.put('/api/basket/', {'items': items}, format='json').json()
+    assert data['Objects updated:'] == 2
+    assert data['basket'] == {'id': data['basket']['id'], 'items': 3,
+                              'total_quantity': 7, 'total_sum': 4 * 1500 + 2 * 1000 + 1000}
+    assert len(data['errors']) == 1
+    assert OrderItem.objects.get(id=lines[ids[0]]).total_amount == 6000
+
+@pytest.mark.django_db
+def test_order_totals_stored(client, user_shop, django_assert_num_queries):
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Contact, Order, OrderItem
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(3))
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    contact = Contact.objects.create(user=user_shop, city='Москва', phone='+7900')
+    client.force_authenticate(user_shop)
+
+    def totals():
+        return tuple(Order.objects.filter(status__in=('basket', 'new')).values_list(
+            'total_quantity', 'total_sum').get())
+
+    lines = {item['product_info']: item['id'] for item in client.post(
+        '/api/basket/', {'items': [{'product_info': ids[0], 'quantity': 2},
+                                   {'product_info': ids[1], 'quantity': 12},
+                                   {'product_info': ids[2]}]},
+        format='json').json()['items']}
+    assert totals() == (15, 15000)
+    client.put('/api/basket/', {'items': [{'id': lines[ids[0]], 'quantity': 3}]}, format='json')
+    assert totals() == (16, 16000)
+    client.delete('/api/basket/', {'items': str(lines[ids[2]])})
+    assert totals() == (15, 15000)
+
+    basket = Order.objects.get(status='basket')
+    client.post('/api/orders/', {'id': str(basket.id), 'contact': contact.id, 'partial': 'true'})
+    assert totals() == (13, 13000)
+    item = OrderItem.objects.get(id=lines[ids[0]])
+    item.quantity = 1
+    item.save()
+    assert totals() == (11, 11000)
+
+    with django_assert_num_queries(1) as context:
+        data = client.get('/api/orders/', {'fields': 'id,total_sum'}).json()
+    assert data == [{'id': basket.id, 'total_sum': 11000}]
+    assert all('SUM(' not in query['sql'] for query in context.captured_queries)
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(1))
+    assert totals() == (1, 1000)
+    # lines removed by a cascade outside the importer update totals as well
+    ProductInfo.objects.filter(id=ids[0]).delete()
+    assert totals() == (0, 0)
+
+@pytest.mark.django_db
+def test_checkout_reserves_stock(client, user_shop, monkeypatch):
+    from . import views
+    from .importer import PriceListImporter
+    from .models import ProductInfo, CatalogEntry, Contact, Order, OrderItem
+    from .reservations import reserve_order
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(2))
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    contact = Contact.objects.create(user=user_shop, city='Москва', phone='+7900')
+    client.force_authenticate(user_shop)
+    client.post('/api/basket/', {'items': [{'product_info': ids[0], 'quantity': 4},
+                                           {'product_info': ids[1], 'quantity': 12}]},
+                format='json')
+    basket = Order.objects.get(status='basket')
+
+    def stock():
+        return (list(ProductInfo.objects.order_by('id').values_list('quantity', flat=True)),
+                list(CatalogEntry.objects.order_by('pk').values_list('quantity', flat=True)))
+
+    data = client.post('/api/orders/', {'id': str(basket.id), 'contact': contact.id}).json()
+    assert data['Error'] == 'Not enough stock'
+    assert [line['reserved'] for line in data['lines']] == [4, 10]
+    assert stock() == ([10, 10], [10, 10])
+    assert Order.objects.get(id=basket.id).status == 'basket'
+
+    data = client.post('/api/orders/', {'id': str(basket.id), 'contact': contact.id,
+                                        'partial': 'true'}).json()
+    assert data['OK'] and data['reservation']['status'] == 'partial'
+    assert stock() == ([6, 0], [6, 0])
+    assert OrderItem.objects.get(order_id=basket.id, product_info_id=ids[1]).total_amount == 10000
+    order = Order.objects.get(id=basket.id)
+    assert (order.status, order.stock_reserved) == ('new', True)
+
+    assert client.delete('/api/orders/', {'id': str(order.id)}).json() == {'OK': True}
+    assert stock() == ([10, 10], [10, 10])
+    assert client.delete('/api/orders/', {'id': str(order.id)}).json() == {
+        'Error': 'Order can not be canceled'}
+
+    # the shop assembles the order between the status check and the cancel
+    order = Order.objects.create(user=user_shop, status='new', contact=contact)
+    order.ordered_items.create(product_info_id=ids[0], quantity=2, price=1000)
+    assert reserve_order(order.id)['status'] == 'reserved'
+    release = views.release_order
+
+    def assembled_meanwhile(order_id, **kwargs):
+        Order.objects.filter(id=order_id).update(status='assembled')
+        return release(order_id, **kwargs)
+    monkeypatch.setattr(views, 'release_order', assembled_meanwhile)
+    assert client.delete('/api/orders/', {'id': str(order.id)}).json() == {
+        'Error': 'Order can not be canceled'}
+    order.refresh_from_db()
+    assert (order.status, order.stock_reserved) == ('assembled', True)
+    assert stock() == ([8, 10], [8, 10])
+
+@pytest.mark.django_db
+def test_shop_order_feed(client, user_shop):
+    from datetime import timedelta
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+    from .importer import PriceListImporter
+    from .models import User, ProductInfo, Order, OrderItem
+
+    other_shop = User.objects.create_user(email='other@shop.kz', password='x',
+                                          username='other', type='shop')
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(2))
+    PriceListImporter(user_id=other_shop.id).run(make_price_list(2, shop='Евросеть', price=500))
+    own = list(ProductInfo.objects.filter(shop__user=user_shop).order_by('id'))
+    other = list(ProductInfo.objects.filter(shop__user=other_shop).order_by('id'))
+    buyer = User.objects.create_user(email='buyer@mail.kz', password='x', username='buyer')
+    now = timezone.now()
+    for day in range(6):
+        order = Order.objects.create(user=buyer, status='new' if day % 2 else 'sent')
+        Order.objects.filter(id=order.id).update(dt=now - timedelta(days=day))
+        OrderItem.objects.create(order=order, product_info=other[0], quantity=1, price=500)
+        if day < 5:
+            OrderItem.objects.create(order=order, product_info=own[day % 2],
+                                     quantity=day + 1, price=1000)
+    Order.objects.create(user=buyer, status='basket').ordered_items.create(
+        product_info=own[0], quantity=1, price=1000)
+
+    client.force_authenticate(user_shop)
+    counts = []
+    for page_size in (2, 5):
+        with CaptureQueriesContext(connection) as context:
+            data = client.get('/api/shop/orders/', {'page_size': page_size}).json()
+        counts.append(len(context))
+    assert counts[0] == counts[1]
+    assert [order['total_sum'] for order in data['results']] == [1000, 2000, 3000, 4000, 5000]
+    assert all(len(order['ordered_items']) == 1 and
+               order['ordered_items'][0]['product_info']['shop'] == own[0].shop_id
+               for order in data['results'])
+
+    data = client.get('/api/shop/orders/', {'page_size': 2, 'fields': 'total_sum'}).json()
+    pages = [order['total_sum'] for order in data['results']]
+    while data['next']:
+        data = client.get(data['next']).json()
+        pages += [order['total_sum'] for order in data['results']]
+    assert pages == [1000, 2000, 3000, 4000, 5000]
+
+    data = client.get('/api/shop/orders/', {
+        'status': 'new', 'dt_from': (now - timedelta(days=3, hours=1)).isoformat(),
+        'dt_to': timezone.localdate().isoformat(), 'fields': 'status,total_sum'}).json()
+    assert data['results'] == [{'status': 'new', 'total_sum': 2000},
+                               {'status': 'new', 'total_sum': 4000}]
+    assert client.get('/api/shop/orders/', {'status': 'basket'}).json() == {
+        'Error': 'Invalid status: basket'}
+    assert client.get('/api/shop/orders/', {'dt_to': 'yesterday'}).json() == {
+        'Error': 'Invalid dt_to'}
+
+@pytest.mark.django_db
+def test_shop_exports(client, user_shop, settings):
+    import csv, gzip, json
+    from .importer import PriceListImporter
+    from .models import User, ProductInfo, Order
+
+    settings.EXPORT_CHUNK_SIZE = 2
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(5))
+    product_infos = list(ProductInfo.objects.order_by('id'))
+    buyer = User.objects.create_user(email='buyer@mail.kz', password='x', username='buyer')
+    for status in ('new', 'sent', 'basket'):
+        order = Order.objects.create(user=buyer, status=status)
+        for quantity, product_info in enumerate(product_infos[:2], 1):
+            order.ordered_items.create(product_info=product_info, quantity=quantity, price=1000)
+    client.force_authenticate(user_shop)
+
+    response = client.get('/api/shop/export/catalog/')
+    assert response.streaming and response['Content-Type'] == 'text/csv; charset=utf-8'
+    chunks = iter(response.streaming_content)
+    assert next(chunks) == b'id,external_id,model,name,category_id,category,quantity,price,price_rrc\r\n'
+    rows = list(csv.reader(b''.join(chunks).decode().splitlines()))
+    assert [int(row[0]) for row in rows] == [product_info.id for product_info in product_infos]
+    assert rows[0][1:4] == ['1000', 'model/0', 'Товар 0']
+
+    response = client.get('/api/shop/export/orders/', {'type': 'ndjson', 'status': 'new'})
+    lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+    assert [(line['status'], line['quantity'], line['total_amount']) for line in lines] == [
+        ('new', 1, 1000), ('new', 2, 2000)]
+
+    response = client.get('/api/shop/export/orders/', HTTP_ACCEPT_ENCODING='gzip')
+    assert response['Content-Encoding'] == 'gzip'
+    assert len(gzip.decompress(b''.join(response.streaming_content)).splitlines()) == 5
+    assert client.get('/api/shop/export/orders/', {'type': 'xml'}).json() == {
+        'Error': 'Invalid type, expected csv or ndjson'}
+
+@pytest.mark.django_db
+def test_shop_order_transitions(client, user_shop, django_capture_on_commit_callbacks):
+    from .importer import PriceListImporter
+    from .models import User, ProductInfo, Order, OutboxMessage
+    from .reservations import reserve_order
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(1))
+    product_info = ProductInfo.objects.get()
+    buyer = User.objects.create_user(email='buyer@mail.kz', password='x', username='buyer')
+    orders = []
+    for status in ('new', 'new', 'confirmed', 'sent', 'new'):
+        order = Order.objects.create(user=buyer, status=status)
+        order.ordered_items.create(product_info=product_info, quantity=2, price=1000)
+        orders.append(order.id)
+    reserve_order(orders[1])
+    foreign = Order.objects.create(user=buyer, status='new')
+    other_shop = User.objects.create_user(email='other@shop.ru', password='x',
+                                          username='other', type='shop')
+    PriceListImporter(user_id=other_shop.id).run(make_price_list(1, shop='Евросеть'))
+    shared = Order.objects.create(user=buyer, status='new')
+    shared.ordered_items.create(product_info=product_info, quantity=1, price=1000)
+    shared.ordered_items.create(product_info=ProductInfo.objects.get(shop__user=other_shop),
+                                quantity=1, price=1000)
+    duplicate = Order.objects.create(user=buyer, status='new')
+    duplicate.ordered_items.create(product_info=product_info, quantity=1, price=1000)
+    client.force_authenticate(user_shop)
+
+    items = [{'id': orders[0], 'status': 'confirmed'}, {'id': orders[1], 'status': 'canceled'},
+             {'id': orders[2], 'status': 'assembled'}, {'id': orders[3], 'status': 'confirmed'},
+             {'id': orders[4], 'status': 'confirmed'}, {'id': foreign.id, 'status': 'confirmed'},
+             {'id': orders[0], 'status': 'basket'}, {'id': shared.id, 'status': 'canceled'},
+             {'id': duplicate.id, 'status': 'confirmed'}, {'id': duplicate.id, 'status': 'canceled'}]
+    with django_capture_on_commit_callbacks() as callbacks:
+        data = client.post('/api/shop/orders/', {'items': items}, format='json').json()
+    assert data['Objects updated'] == 4
+    assert [item.get('previous') for item in data['items'][:5]] == [
+        'new', 'new', 'confirmed', None, 'new']
+    assert data['items'][3]['errors'] == {'status': ['Invalid transition sent -> confirmed']}
+    assert data['items'][5]['errors'] == {'status': ['Order not found']}
+    assert 'status' in data['items'][6]['errors']
+    assert data['items'][7]['errors'] == {'status': ['Order contains items of other shops']}
+    assert [item['errors'] for item in data['items'][8:]] == [
+        {'status': ['Duplicate order id']}] * 2
+    assert list(Order.objects.filter(id__in=orders).order_by('id').values_list(
+        'status', flat=True)) == ['confirmed', 'canceled', 'assembled', 'sent', 'confirmed']
+    assert Order.objects.get(id=shared.id).status == 'new'
+    assert Order.objects.get(id=duplicate.id).status == 'new'
+    assert ProductInfo.objects.get(shop__user=user_shop).quantity == 10
+    assert OutboxMessage.objects.count() == 4
+    assert [callback.__name__ for callback in callbacks].count('dispatch_outbox') == 1
+
+@pytest.mark.django_db
+def test_cached_token_authentication(client, user_shop, admin, django_assert_num_queries):
+    from time import time
+    from .authentication import TokenCache, token_cache
+    from .store import get_redis
+
+    token = client.post('/api/user/login/', {'email': 'df33@dsa.kz',
+                                             'password': 'sd43fdsf'}).json()['OK']
+    client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+    with django_assert_num_queries(2):
+        assert client.get('/api/user/details/').json()['type'] == 'shop'
+    # token and user come from the cache, only contacts are read
+    with django_assert_num_queries(1):
+        assert client.get('/api/user/details/').json()['email'] == 'df33@dsa.kz'
+    token_cache.local.clear()
+    with django_assert_num_queries(1):
+        client.get('/api/user/details/')
+    assert token_cache.stats()['redis'] == {'hits': 1, 'misses': 1}
+
+    client.post('/api/user/details/', {'password': 'New-pass-2023', 'company': 'Связной'})
+    user_shop.refresh_from_db()
+    assert user_shop.check_password('New-pass-2023') and user_shop.company == 'Связной'
+    with django_assert_num_queries(2):
+        client.get('/api/user/details/')
+
+    # another process revokes the token, the local entry here is dropped
+    assert token_cache.local.get(token) is not None
+    TokenCache().invalidate([token])
+    with django_assert_num_queries(2):
+        client.get('/api/user/details/')
+    with django_assert_num_queries(1):
+        client.get('/api/user/details/')
+
+    # a row read before a revocation and cached after it is not kept
+    values, read_at = token_cache.get(token), time()
+    token_cache.local.clear()
+    TokenCache().invalidate([token])
+    token_cache.set(token, values, read_at)
+    assert token_cache.local.get(token) is None
+    assert get_redis().get(TokenCache.redis_key(token)) is None
+
+    user_shop.is_active = False
+    user_shop.save()
+    assert client.get('/api/user/details/').json() == {'detail': 'User inactive or deleted.'}
+    user_shop.is_active = True
+    user_shop.save()
+    assert client.post('/api/user/logout/').json() == {'OK': True}
+    assert client.get('/api/user/details/').json() == {'detail': 'Invalid token.'}
+
+    admin.is_staff = True
+    admin.save()
+    client.force_authenticate(admin)
+    assert 'tokens' in client.get('/api/stats/caches/').json()
+
+def test_shared_throttle(monkeypatch, settings):
+    from types import SimpleNamespace
+    from fakeredis import FakeRedis
+    from redis.exceptions import ConnectionError, ResponseError
+    from django.contrib.auth.models import AnonymousUser
+    from . import throttling
+    from .throttling import SharedAnonRateThrottle
+
+    class Throttle(SharedAnonRateThrottle):
+        rate = '3/min'
+
+    now = [1000.0]
+    monkeypatch.setattr(throttling, 'time', lambda: now[0])
+    request = SimpleNamespace(user=AnonymousUser(), META={'REMOTE_ADDR': '10.0.0.1'})
+    # every request gets a new throttle instance, as every worker would
+    assert [Throttle().allow_request(request, None) for _ in range(4)] == [True] * 3 + [False]
+    throttle = Throttle()
+    assert not throttle.allow_request(request, None) and throttle.wait() == pytest.approx(20)
+    now[0] += 20
+    assert [Throttle().allow_request(request, None) for _ in range(2)] == [True, False]
+    other = SimpleNamespace(user=AnonymousUser(), META={'REMOTE_ADDR': '10.0.0.2'})
+    assert Throttle().allow_request(other, None)
+
+    calls = []
+
+    def down(*args):
+        calls.append(args)
+        raise ConnectionError('down')
+    monkeypatch.setattr(throttling, 'take_local', down)
+    monkeypatch.setattr(throttling, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(throttling, 'outage', {'until': 0})
+    # an outage lets requests through and is not retried until the backoff ends
+    assert all(Throttle().allow_request(request, None) for _ in range(3)) and len(calls) == 1
+    now[0] += settings.THROTTLE_REDIS_BACKOFF
+    assert Throttle().allow_request(request, None) and len(calls) == 2
+
+    def broken(*args):
+        raise ResponseError('script error')
+    monkeypatch.setattr(throttling, 'take_local', broken)
+    now[0] += settings.THROTTLE_REDIS_BACKOFF
+    with pytest.raises(ResponseError):
+        Throttle().allow_request(request, None)
+
+    # the Lua bucket on a real Redis protocol implementation
+    redis = FakeRedis()
+    monkeypatch.setattr(throttling, 'get_redis', lambda: redis)
+    assert [Throttle().allow_request(other, None) for _ in range(4)] == [True] * 3 + [False]
+    throttle = Throttle()
+    assert not throttle.allow_request(other, None)
+    assert throttle.wait() == pytest.approx(20, abs=1)
+
+@pytest.mark.django_db(transaction=True)
+def test_outbox_delivery(client, user_shop, settings):
+    from datetime import timedelta
+    from django.utils import timezone
+    from orders.celery import app
+    from .benchmarks import SMTPStandIn
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Contact, Order, OutboxMessage
+    from .outbox import enqueue_email, drain_outbox_messages
+    from django.db import transaction
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(1))
+    contact = Contact.objects.create(user=user_shop, city='Москва', phone='+7900')
+    client.force_authenticate(user_shop)
+    with SMTPStandIn(refuse={'nobody@mail.kz'}) as server:
+        for name, value in server.settings().items():
+            setattr(settings, name, value)
+        settings.OUTBOX_BATCH_SIZE = 2
+        # drains started after commit run in place of a worker
+        app.conf.task_always_eager = True
+        try:
+            client.post('/api/basket/', {'items': [{'product_info': ProductInfo.objects.get().id}]},
+                        format='json')
+            basket = Order.objects.get(status='basket')
+            client.post('/api/orders/', {'id': str(basket.id), 'contact': contact.id})
+            assert [recipients for recipients, _ in server.messages] == [[user_shop.email]]
+            assert OutboxMessage.objects.get().status == 'sent'
+
+            with transaction.atomic():
+                enqueue_email('Lost', 'rolled back', 'buyer@mail.kz')
+                transaction.set_rollback(True)
+            server.connections = 0
+            with transaction.atomic():
+                for i in range(4):
+                    enqueue_email(f'Mail {i}', 'text', f'buyer{i}@mail.kz')
+                refused = enqueue_email('Refused', 'text', 'nobody@mail.kz')
+        finally:
+            app.conf.task_always_eager = False
+        assert server.connections == 1 and len(server.messages) == 5
+        assert OutboxMessage.objects.filter(status='sent').count() == 5
+
+        refused.refresh_from_db()
+        assert (refused.status, refused.attempts) == ('pending', 1)
+        assert 'SMTPRecipientsRefused' in refused.last_error
+        assert drain_outbox_messages() == {'sent': 0, 'retry': 0, 'failed': 0}
+        OutboxMessage.objects.filter(id=refused.id).update(available_at=timezone.now())
+        assert drain_outbox_messages() == {'sent': 0, 'retry': 1, 'failed': 0}
+        for attempt in range(3, settings.OUTBOX_MAX_ATTEMPTS + 1):
+            OutboxMessage.objects.filter(id=refused.id).update(available_at=timezone.now())
+            drain_outbox_messages()
+            refused.refresh_from_db()
+            assert refused.attempts == attempt
+            if refused.status == 'pending':
+                assert refused.available_at - timezone.now() > timedelta(
+                    seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (attempt - 1) - 5)
+        assert refused.status == 'failed'
+
+        # a malformed address fails the message alone, the rest of the batch is sent
+        bad = [OutboxMessage.objects.create(subject='Bad', body='text', to_email=address)
+               for address in ('a@b@c', '<>')]
+        OutboxMessage.objects.create(subject='Good', body='text', to_email='good@mail.kz')
+        assert drain_outbox_messages() == {'sent': 1, 'retry': 2, 'failed': 0}
+        assert server.messages[-1][0] == ['good@mail.kz']
+        for message in bad:
+            message.refresh_from_db()
+            assert (message.status, message.attempts) == ('pending', 1)
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_checkout_never_oversells(user_shop):
+    from time import sleep
+    from concurrent.futures import ThreadPoolExecutor
+    from django.db import connection, OperationalError
+    from .importer import PriceListImporter
+    from .models import ProductInfo, Order, OrderItem, User
+    from .reservations import reserve_order
+
+    PriceListImporter(user_id=user_shop.id).run(make_price_list(1))
+    product_info = ProductInfo.objects.get()
+    orders = []
+    for i in range(16):
+        buyer = User.objects.create_user(email=f'buyer{i}@test.test', password='x',
+                                         username=f'buyer{i}')
+        order = Order.objects.create(user=buyer, status='new')
+        OrderItem.objects.create(order=order, product_info=product_info, quantity=1, price=1000)
+        orders.append(order.id)
+
+    def checkout(order_id):
+        # in-memory test SQLite reports lock conflicts instead of waiting for them
+        try:
+            while True:
+                try:
+                    return reserve_order(order_id)['status']
+                except OperationalError:
+                    sleep(0.001)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(8) as executor:
+        statuses = list(executor.map(checkout, orders))
+    assert statuses.count('reserved') == 10 and statuses.count('rejected') == 6
+    assert ProductInfo.objects.get().quantity == 0
+    assert Order.objects.filter(stock_reserved=True).count() == 10
@@ -0,0 +1,112 @@
+from math import ceil
+from time import monotonic, time
+
+from django.conf import settings
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+
+from .store import FakeRedis, get_redis
+
+
+__all__ = [
+    'take_token',
+    'SharedAnonRateThrottle',
+    'SharedUserRateThrottle',
+]
+
+# token bucket: capacity tokens, refilled at rate tokens/s by server time,
+# one HMGET + HSET + EXPIRE inside the script, one round trip per request
+TOKEN_BUCKET = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+if tokens == nil then
+    tokens = capacity
+else
+    tokens = math.min(capacity, tokens + math.max(0, now - tonumber(state[2])) * rate)
+end
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return {allowed, tostring((1 - tokens) / rate)}
+'''
+
+scripts = {}
+# monotonic time until which an unreachable Redis is not asked again
+outage = {'until': 0}
+
+
+def take_local(client, key, capacity, rate, ttl):
+    '''the same bucket for FakeRedis, atomic under its lock'''
+    with client.lock:
+        state = client.get(key)
+        now = time()
+        if state is None:
+            tokens = capacity
+        else:
+            tokens, updated = map(float, state.split(b':'))
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        client.set(key, f'{tokens}:{now}', ex=ttl)
+    return allowed, (1 - tokens) / rate
+
+
+def take_token(key, num_requests, duration):
+    '''
+    Взять токен из общего ведра key (num_requests за duration секунд):
+    (разрешено, через сколько секунд появится следующий токен)
+    '''
+    client = get_redis()
+    rate, ttl = num_requests / duration, ceil(duration)
+    if isinstance(client, FakeRedis):
+        return take_local(client, key, num_requests, rate, ttl)
+    if client not in scripts:
+        scripts[client] = client.register_script(TOKEN_BUCKET)
+    allowed, wait = scripts[client](keys=[key], args=[num_requests, rate, ttl])
+    return bool(allowed), float(wait)
+
+
+class SharedRateThrottleMixin:
+    '''
+    Ограничение частоты запросов по ведру токенов в Redis, общему для всех
+    воркеров; недоступный Redis запросы не ограничивает и не опрашивается
+    THROTTLE_REDIS_BACKOFF секунд
+    '''
+    wait_seconds = None
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        if monotonic() < outage['until']:
+            return True
+        try:
+            allowed, self.wait_seconds = take_token(key, self.num_requests, self.duration)
+        except (RedisConnectionError, RedisTimeoutError):
+            outage['until'] = monotonic() + settings.THROTTLE_REDIS_BACKOFF
+            return True
+        return allowed
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class SharedAnonRateThrottle(SharedRateThrottleMixin, AnonRateThrottle):
+    pass
+
+
+class SharedUserRateThrottle(SharedRateThrottleMixin, UserRateThrottle):
+    pass
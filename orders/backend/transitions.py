@@ -0,0 +1,95 @@
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import *
+from .models import STATUS_CHOICES
+from .serializers import OrderStatusSerializer
+from .partner import shop_orders
+from .reservations import return_stock
+from .outbox import enqueue_emails
+
+
+__all__ = [
+    'ORDER_TRANSITIONS',
+    'transition_orders',
+]
+
+ORDER_TRANSITIONS = {
+    'new': ('confirmed', 'canceled'),
+    'confirmed': ('assembled', 'canceled'),
+    'assembled': ('sent', 'canceled'),
+    'sent': ('delivered',),
+}
+STATUS_NAMES = dict(STATUS_CHOICES)
+
+
+def sources(status):
+    '''statuses an order may move to status from'''
+    return [source for source, targets in ORDER_TRANSITIONS.items() if status in targets]
+
+
+def transition_orders(user_id, items):
+    '''
+    Смена статусов заказов магазина пачкой [{'id', 'status'}]: переходы
+    проверяются по ORDER_TRANSITIONS, на каждый целевой статус одно условное
+    UPDATE, отмена возвращает резерв на склад, письма покупателям уходят
+    одной отправкой после коммита. Заказы с позициями других магазинов
+    и повторные id отклоняются. Возвращает (число обновленных, результат
+    по каждой позиции)
+    '''
+    results, targets, errors = [], {}, {}
+    for item in items:
+        serializer = OrderStatusSerializer(data=item)
+        if serializer.is_valid():
+            order_id = serializer.validated_data['id']
+            if order_id in targets:
+                errors[order_id] = 'Duplicate order id'
+            targets[order_id] = serializer.validated_data['status']
+            results.append({'id': order_id, 'status': serializer.validated_data['status']})
+        else:
+            results.append({'item': item, 'errors': serializer.errors})
+
+    with transaction.atomic():
+        foreign_items = OrderItem.objects.filter(order_id=OuterRef('id')).exclude(
+            product_info__shop__user_id=user_id)
+        current = {order_id: (status, stock_reserved, shared)
+                   for order_id, status, stock_reserved, shared
+                   in shop_orders(user_id, {}).filter(id__in=targets).annotate(
+                       shared=Exists(foreign_items)).select_for_update(
+                       ).values_list('id', 'status', 'stock_reserved', 'shared')}
+        moves = {}
+        for order_id, status in targets.items():
+            if order_id in errors:
+                continue
+            if order_id not in current:
+                errors[order_id] = 'Order not found'
+            elif current[order_id][2]:
+                # the status and the reserve of other shops lines are not ours to change
+                errors[order_id] = 'Order contains items of other shops'
+            elif status not in ORDER_TRANSITIONS.get(current[order_id][0], ()):
+                errors[order_id] = f'Invalid transition {current[order_id][0]} -> {status}'
+            else:
+                moves.setdefault(status, []).append(order_id)
+
+        updated = 0
+        for status, order_ids in sorted(moves.items()):
+            orders = Order.objects.filter(id__in=order_ids, status__in=sources(status))
+            if status == 'canceled':
+                reserved = [order_id for order_id in order_ids if current[order_id][1]]
+                updated += orders.update(status=status, stock_reserved=False)
+                return_stock(reserved)
+            else:
+                updated += orders.update(status=status)
+
+        enqueue_emails([
+            ('Update order status', f'Order {order_id}: {STATUS_NAMES[status]}', email)
+            for order_id, status, email in Order.objects.filter(
+                id__in=[order_id for order_ids in moves.values() for order_id in order_ids]
+            ).order_by('id').values_list('id', 'status', 'user__email')])
+
+    for result in results:
+        if result.get('id') in errors:
+            result['errors'] = {'status': [errors[result['id']]]}
+        elif 'errors' not in result:
+            result['previous'] = current[result['id']][0]
+    return updated, results
@@ -16,6 +16,7 @@ urlpatterns = [
     path('user/register/', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm/', ConfirmAccount.as_view(), name='user-register-confirm'),
     path('user/login/', LoginAccount.as_view(), name='user-login'),
+    path('user/logout/', LogoutAccount.as_view(), name='user-logout'),
     path('user/details/', AccountDetails.as_view(), name='user-details'),
     path('user/contacts/', Contact.as_view(), name='user-contacts'),
     path('user/password_reset/', reset_password_request_token, name='password-reset'),
@@ -26,6 +27,12 @@ urlpatterns = [
 
     path('shop/state/', PartnerState.as_view(), name='shop-state'),
     path('shop/orders/', PartnerOrders.as_view(), name='shop-orders'),
+    path('shop/export/orders/', PartnerExport.as_view(), {'kind': 'orders'},
+         name='shop-export-orders'),
+    path('shop/export/catalog/', PartnerExport.as_view(), {'kind': 'catalog'},
+         name='shop-export-catalog'),
+
+    path('stats/caches/', CacheStats.as_view(), name='stats-caches'),
 
     path('', include(router.urls)),
 ] + router.urls
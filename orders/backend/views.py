@@ -1,6 +1,5 @@
-from django.db import IntegrityError
-from django.db.models import Q, Sum, F
-from django.db.models.query import Prefetch
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 
@@ -8,18 +7,33 @@ from rest_framework import fields
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.authtoken.models import Token
+from celery.result import AsyncResult
 from drf_spectacular.utils import extend_schema, inline_serializer
-from rest_framework.throttling import AnonRateThrottle
 
 from distutils.util import strtobool
-from yaml import safe_load
 from ujson import loads
 
 from .models import *
+from .models import IMPORT_MODE_CHOICES
 from .serializers import *
 from .tasks import *
+from .lookups import lookup_stats
+from .authentication import token_cache
+from .throttling import SharedAnonRateThrottle
+from .catalog import *
+from .pagination import *
+from .search import search_catalog
+from .facets import *
+from .fieldsets import *
+from .renderers import ListResponse
+from .basket import *
+from .reservations import *
+from .partner import *
+from .outbox import enqueue_email
+from .transitions import *
+from .exports import *
 
 
 __all__ = [
@@ -27,6 +41,7 @@ __all__ = [
     'RegisterAccount',
     'ConfirmAccount',
     'LoginAccount',
+    'LogoutAccount',
     'AccountDetails',
     'Contact',
     'CategoryView',
@@ -34,9 +49,11 @@ __all__ = [
     'PartnerUpdateView',
     'PartnerState',
     'PartnerOrders',
+    'PartnerExport',
     'ProductInfoView',
     'Basket',
     'Orders',
+    'CacheStats',
 ]
 
 MSG_NO_REQUIRED_FIELDS = 'No required fields'
@@ -45,13 +62,14 @@ class MainPage(APIView):
     '''
     Навигация 
     '''
-    throttle_classes = [AnonRateThrottle]
+    throttle_classes = [SharedAnonRateThrottle]
 
     def get(self, request):
         data = {
             'user-register': 'http://127.0.0.1:8000/api/user/register/',
             'user-register-confirm': 'http://127.0.0.1:8000/api/user/register/confirm/',
             'user-login': 'http://127.0.0.1:8000/api/user/login/',
+            'user-logout': 'http://127.0.0.1:8000/api/user/logout/',
             'user-details': 'http://127.0.0.1:8000/api/user/details/',
             'user-contacts': 'http://127.0.0.1:8000/api/user/contacts/',
             'user-password-reset': 'http://127.0.0.1:8000/api/user/password_reset/',
@@ -62,8 +80,11 @@ class MainPage(APIView):
             'products': 'http://127.0.0.1:8000/api/products/',
             'shops': 'http://127.0.0.1:8000/api/shops/',
             'shop-update-price': 'http://127.0.0.1:8000/api/shop/update/',
+            'shop-update-status': 'http://127.0.0.1:8000/api/shop/update/<job_id>/',
             'shop-state': 'http://127.0.0.1:8000/api/shop/state/',
             'shop-orders': 'http://127.0.0.1:8000/api/shop/orders/',
+            'shop-export-orders': 'http://127.0.0.1:8000/api/shop/export/orders/?type=csv',
+            'shop-export-catalog': 'http://127.0.0.1:8000/api/shop/export/catalog/?type=ndjson',
             'api-swagger': 'http://127.0.0.1:8000/api/swagger/',
             'api-redoc': 'http://127.0.0.1:8000/api/redoc/',
         }
@@ -142,6 +163,17 @@ class LoginAccount(APIView):
         return Response({'Error': 'Invalid request'})
     
 
+class LogoutAccount(APIView):
+    '''
+    Выход: токен удаляется и сразу перестает действовать
+    '''
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        Token.objects.filter(user_id=request.user.id).delete()
+        return Response({'OK': True})
+
+
 class AccountDetails(APIView):
     '''
     Информация о пользователе
@@ -230,22 +262,26 @@ class Contact(APIView):
         return Response({'Error': MSG_NO_REQUIRED_FIELDS})
 
 
-class CategoryView(ModelViewSet):
+class CategoryView(CatalogListMixin, ModelViewSet):
     '''
     Список категорий
     '''
+    catalog_scope = 'categories'
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    pagination_class = KeysetPagination
     ordering = ('name',)
     http_method_names = ('get',)
 
 
-class ShopView(ModelViewSet):
+class ShopView(CatalogListMixin, ModelViewSet):
     '''
     Список магазинов
     '''
+    catalog_scope = 'shops'
     queryset = Shop.objects.all()
     serializer_class = ShopSerializer
+    pagination_class = KeysetPagination
     ordering = ('name',)
     http_method_names = ('get',)
 
@@ -254,50 +290,44 @@ class PartnerUpdateView(ModelViewSet):
     '''
     Обновление прайса магазина
     '''
-    queryset = Shop.objects.none()
-    serializer_class = ShopSerializer
+    serializer_class = ImportJobSerializer
     permission_classes = [IsAuthenticated]
+    http_method_names = ('get', 'post',)
 
+    def get_queryset(self):
+        return ImportJob.objects.filter(user_id=self.request.user.id)
+
+    @extend_schema(request=inline_serializer('shop-update',{
+        'file_name': fields.FileField(),
+        'mode': fields.ChoiceField(choices=IMPORT_MODE_CHOICES, required=False),
+    }))
     def create(self, request):
         if request.user.type != 'shop':
             return Response({'Error': 'Only for shops'})
 
         file = request.data.get('file_name')
+        mode = request.data.get('mode', 'incremental')
+        if mode not in dict(IMPORT_MODE_CHOICES):
+            return Response({'Error': 'Invalid mode'})
         if file:
-            try:
-                data = safe_load(file)
-            except Exception as error:
-                return Response({'Error': str(error)})
-
-            shop, _ = Shop.objects.get_or_create(user_id=request.user.id,
-                                                 defaults={'name': data['shop']})
-
-            for category in data['categories']:
-                new_cat, __ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                new_cat.shops.add(shop.id)
-                new_cat.save()
-
-            ProductInfo.objects.filter(shop_id=shop.id).all().delete()
-            for item in data['goods']:
-                product, _ = Product.objects.get_or_create(name=item['name'],
-                                                           category_id=item['category'])
-                
-                product_info = ProductInfo.objects.create(product_id=product.id,
-                                                          external_id=item['id'],
-                                                          model=item['model'],
-                                                          price=item['price'],
-                                                          price_rrc=item['price_rrc'],
-                                                          quantity=item['quantity'],
-                                                          shop_id=shop.id)
-                
-                for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
-            return Response(data)
+            job = ImportJob.objects.create(user_id=request.user.id,
+                                           shop=Shop.objects.filter(user_id=request.user.id).first(),
+                                           file=file,
+                                           mode=mode)
+            transaction.on_commit(lambda: import_price_list.delay(job.id))
+            return Response({'job': job.id, 'status': job.status})
         return Response({'Error': 'Invalid file'})
 
+    def retrieve(self, request, pk=None):
+        '''get import status'''
+        job = self.get_object()
+        if job.status == 'running' and job.task_id:
+            progress = AsyncResult(job.task_id).info
+            if isinstance(progress, dict):
+                job.phase = progress.get('phase', job.phase)
+                job.rows_processed = progress.get('rows_processed', job.rows_processed)
+        return Response(self.get_serializer(job).data)
+
 
 class PartnerState(APIView):
     '''
@@ -326,6 +356,10 @@ class PartnerState(APIView):
                 Shop.objects.filter(
                     user_id=request.user.id
                 ).update(state=strtobool(state))
+                CatalogEntry.objects.filter(
+                    shop_id=request.user.shop.id
+                ).update(shop_state=strtobool(state))
+                bump_catalog_version(request.user.shop.id)
                 return Response(ShopSerializer(request.user.shop).data)
             
             except ValueError as error:
@@ -335,7 +369,8 @@ class PartnerState(APIView):
 
 class PartnerOrders(APIView):
     ''''
-    Заказы магазина
+    Заказы магазина: только свои позиции и их сумма, курсор по дате,
+    фильтры status, dt_from, dt_to; POST - смена статусов пачкой
     '''
     permission_classes = [IsAuthenticated]
 
@@ -343,39 +378,122 @@ class PartnerOrders(APIView):
         if request.user.type != 'shop':
             return Response({'Error': 'Only for shops'})
         
-        qureyset = OrderItem.objects.filter(product_info__shop__user_id=request.user.id)
-        pr = Prefetch('ordered_items', qureyset)
-        order = Order.objects.filter(user_id=request.user.id).exclude(status='basket').prefetch_related(
-            pr).select_related('contact').annotate(
-            total_sum=Sum('ordered_items__total_amount'),
-            total_quantity=Sum('ordered_items__quantity'))
-        
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        try:
+            fieldset = Fieldset.from_request(request, ORDER_FIELDS, ORDER_EXPANDABLE)
+            filters = parse_order_filters(request.query_params)
+        except ValueError as error:
+            return Response({'Error': str(error)})
+
+        paginator = OrderFeedPagination()
+        rows = paginator.paginate_queryset(
+            shop_orders(request.user.id, filters).values('id', 'dt'), request, self)
+        serializer = OrderSerializer(shop_order_page(rows), many=True,
+                                     context={'fieldset': fieldset, 'line_totals': True,
+                                              'ordered_items': shop_order_items(request.user.id)})
+        return paginator.get_paginated_response(serializer.data)
+
+    @extend_schema(request=inline_serializer('shop-orders-status',{
+        'items': fields.ListField(),
+    }))
+    def post(self, request):
+        '''change status of shop orders, items: [{"id": 1, "status": "confirmed"}]'''
+        if request.user.type != 'shop':
+            return Response({'Error': 'Only for shops'})
+
+        items_sting = request.data.get('items')
+        if items_sting:
+            try:
+                items_list = loads(items_sting) if isinstance(items_sting, str) else items_sting
+            except:
+                return Response({'Error': 'Invalid format request'})
+            if not isinstance(items_list, list):
+                return Response({'Error': 'Invalid format request'})
+            updated, results = transition_orders(request.user.id, items_list)
+            return Response({'Objects updated': updated, 'items': results})
+        return Response({'Error': MSG_NO_REQUIRED_FIELDS})
+
+
+class PartnerExport(APIView):
+    '''
+    Выгрузка магазина потоком: orders - позиции своих заказов (фильтры
+    как у ленты заказов), catalog - свои предложения; ?type=csv или ndjson
+    '''
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, kind):
+        if request.user.type != 'shop':
+            return Response({'Error': 'Only for shops'})
+
+        export_type = request.query_params.get('type', 'csv')
+        if export_type not in EXPORT_TYPES:
+            return Response({'Error': 'Invalid type, expected csv or ndjson'})
+        if kind == 'orders':
+            try:
+                filters = parse_order_filters(request.query_params)
+            except ValueError as error:
+                return Response({'Error': str(error)})
+            columns, rows = order_export(request.user.id, filters)
+        else:
+            columns, rows = catalog_export(request.user.id)
+        return export_response(export_type, columns, rows, kind)
 
 
-class ProductInfoView(ReadOnlyModelViewSet):
+class ProductInfoView(CatalogListMixin, ReadOnlyModelViewSet):
     '''
     Поиск товаров
     '''
-    serializer_class = ProductInfoSerializer
+    catalog_scope = 'products'
+    serializer_class = CatalogEntrySerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        query = Q(shop__state=True)
+        query = Q(shop_state=True)
         shop_id = self.request.query_params.get('shop_id')
         category_id = self.request.query_params.get('category_id')
 
         if shop_id:
             query = query & Q(shop_id=shop_id)
         if category_id:
-            query = query & Q(product__category_id=category_id)
-        
-        queryset = ProductInfo.objects.filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
-        
+            query = query & Q(category_id=category_id)
+
+        queryset = filter_catalog(CatalogEntry.objects.filter(query),
+                                  getattr(self, 'filters', {}))
+        fieldset = getattr(self, 'fieldset', None)
+        if fieldset is not None and fieldset.fields is not None:
+            queryset = queryset.only(*CatalogEntryListSerializer.model_fields(fieldset))
+        search = self.request.query_params.get('q')
+        if search:
+            queryset = search_catalog(queryset, search)
         return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fieldset'] = getattr(self, 'fieldset', None)
+        return context
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = (SearchPagination() if self.request.query_params.get('q')
+                               else KeysetPagination())
+        return self._paginator
+
+    def get_catalog_shop_id(self):
+        return self.request.query_params.get('shop_id')
+
+    def get_catalog_data(self, request, *args, **kwargs):
+        data = super().get_catalog_data(request, *args, **kwargs)
+        data['facets'] = catalog_facets(self.get_queryset())
+        return data
+
+    def list(self, request, *args, **kwargs):
+        try:
+            self.filters = parse_catalog_filters(request.query_params)
+            self.fieldset = Fieldset.from_request(request, PRODUCT_INFO_FIELDS,
+                                                  PRODUCT_INFO_EXPANDABLE)
+        except ValueError as error:
+            return Response({'Error': str(error)})
+        return super().list(request, *args, **kwargs)
     
 
 class Basket(APIView):
@@ -386,14 +504,16 @@ class Basket(APIView):
 
     def get(self, request):
         '''get basket'''
+        try:
+            fieldset = Fieldset.from_request(request, ORDER_FIELDS, ORDER_EXPANDABLE)
+        except ValueError as error:
+            return Response({'Error': str(error)})
+
         basket = Order.objects.filter(
-            user_id=request.user.id, status='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
-        
-        serializer = OrderSerializer(basket, many=True)
-        return Response(serializer.data)
+            user_id=request.user.id, status='basket')
+
+        serializer = OrderSerializer(basket, many=True, context={'fieldset': fieldset})
+        return ListResponse(serializer.data)
     
     @extend_schema(request=inline_serializer('basket-post',{
         'items': fields.ListField(),
@@ -403,26 +523,21 @@ class Basket(APIView):
         items_sting = request.data.get('items')
         if items_sting:
             try:
-                items_dict = loads(items_sting)
+                items_dict = loads(items_sting) if isinstance(items_sting, str) else items_sting
             except:
                 return Response({'Error': 'Invalid format request'})
-            else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id,
-                                                        state='basket')
-                objects_created = 0
-
-                for order_item in items_dict:
-                    order_item.update({'order': basket.id})
-                    serializer = OrderItemCreateSerializer(data=order_item)
-                    
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return Response({'Error': str(error)})
-                        else:
-                            objects_created += 1
-                    return Response({'Error': serializer.errors})
+            if not isinstance(items_dict, list):
+                return Response({'Error': 'Invalid format request'})
+            try:
+                results = add_to_basket(request.user.id, items_dict)
+            except IntegrityError as error:
+                return Response({'Error': str(error)})
+            # one basket line per product_info, however many items name it
+            statuses = {result['product_info']: result['status'] for result in results
+                        if result['status'] != 'error'}
+            return Response({'Objects created': list(statuses.values()).count('created'),
+                             'Objects updated': list(statuses.values()).count('updated'),
+                             'items': results})
         return Response({'Error': MSG_NO_REQUIRED_FIELDS})
 
     def delete(self, request):
@@ -441,7 +556,8 @@ class Basket(APIView):
                     objects_deleted = True
             
             if objects_deleted:
-                deleted_count = OrderItem.objects.filter(query).delete()[0]
+                with transaction.atomic(), Order.deferred_totals():
+                    deleted_count = OrderItem.objects.filter(query).delete()[0]
                 return Response({'Deleted count': deleted_count})
         return Response({'Error': MSG_NO_REQUIRED_FIELDS})
     
@@ -450,18 +566,16 @@ class Basket(APIView):
         items_sting = request.data.get('items')
         if items_sting:
             try:
-                items_dict = loads(items_sting)
+                items_dict = loads(items_sting) if isinstance(items_sting, str) else items_sting
             except:
                 return Response({'Error': 'Invalid format request'})
-            else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id,
-                                                        status='basket')
-                object_updated = 0
-                for order_item in items_dict:
-                    if type(order_item['id']) == int and type(order_item['quantity']) == int:
-                        object_updated += OrderItem.objects.filter(
-                            order_id=basket.id, id=order_item['id']).update(quantity=order_item['quantity'])
-                return Response({'Objects updated:': object_updated})
+            if not isinstance(items_dict, list):
+                return Response({'Error': 'Invalid format request'})
+            object_updated, errors, summary = update_basket(request.user.id, items_dict)
+            response = {'Objects updated:': object_updated, 'basket': summary}
+            if errors:
+                response['errors'] = errors
+            return Response(response)
         return Response({'Error': MSG_NO_REQUIRED_FIELDS})
 
 
@@ -473,13 +587,15 @@ class Orders(APIView):
 
     def get(self, request):
         '''get order status'''
+        try:
+            fieldset = Fieldset.from_request(request, ORDER_FIELDS, ORDER_EXPANDABLE)
+        except ValueError as error:
+            return Response({'Error': str(error)})
+
         order = Order.objects.filter(
-            user_id=request.user.id).exclude(status='basket').select_related(
-            'contact').prefetch_related('ordered_items').annotate(
-            total_quantity=Sum('ordered_items__quantity'),
-            total_sum=Sum('ordered_items__total_amount')).distinct()
-        seriazlier = OrderSerializer(order, many=True)
-        return Response(seriazlier.data)
+            user_id=request.user.id).exclude(status='basket')
+        seriazlier = OrderSerializer(order, many=True, context={'fieldset': fieldset})
+        return ListResponse(seriazlier.data)
     
     @extend_schema(request=inline_serializer('basket-post',{
         'id': fields.CharField(),
@@ -487,21 +603,58 @@ class Orders(APIView):
     }))
     def post(self, request):
         '''change order status'''
-        if request.data['id'].isdigit():
+        if str(request.data.get('id', '')).isdigit():
+            partial = str(request.data.get('partial', '')).lower() in ('1', 'true', 'yes')
+            reservation = None
             try:
-                is_updated = Order.objects.filter(
-                    id=request.data['id'], user_id=request.user.id).update(
-                    contact_id=request.data['contact'], status='new')
-            except:
+                with transaction.atomic():
+                    is_updated = Order.objects.filter(
+                        id=request.data['id'], user_id=request.user.id, status='basket').update(
+                        contact_id=request.data['contact'], status='new')
+                    if is_updated:
+                        reservation = reserve_order(request.data['id'], partial=partial)
+                        if reservation['status'] == 'rejected':
+                            transaction.set_rollback(True)
+                        else:
+                            enqueue_email('Update order status', 'Order is formed',
+                                          request.user.email)
+            except (KeyError, ValueError, IntegrityError):
                 return Response({'Error': 'Invalid format request'})
             else:
 
+                if reservation and reservation['status'] == 'rejected':
+                    return Response({'Error': 'Not enough stock',
+                                     'lines': reservation['lines']})
                 if is_updated:
-                    send_email(
-                        'Update order status',
-                        'Order is formed',
-                        request.user.email
-                    )
-                    return Response({'OK': True})
+                    return Response({'OK': True, 'reservation': reservation})
+
+        return Response({'Error': MSG_NO_REQUIRED_FIELDS})
 
+    @extend_schema(request=inline_serializer('order-cancel',{
+        'id': fields.CharField(),
+    }))
+    def delete(self, request):
+        '''cancel order and release reserved stock'''
+        if str(request.data.get('id', '')).isdigit():
+            cancelable = ('new', 'confirmed')
+            order_id = Order.objects.filter(
+                id=request.data['id'], user_id=request.user.id,
+                status__in=cancelable).values_list('id', flat=True).first()
+            # the shop may move the order on meanwhile, so both UPDATEs check the status again
+            if order_id is not None and (
+                    release_order(order_id, sources=cancelable)
+                    or Order.objects.filter(id=order_id, status__in=cancelable).update(
+                        status='canceled')):
+                return Response({'OK': True})
+            return Response({'Error': 'Order can not be canceled'})
         return Response({'Error': MSG_NO_REQUIRED_FIELDS})
+
+
+class CacheStats(APIView):
+    '''
+    Статистика кешей
+    '''
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({'lookups': lookup_stats(), 'tokens': token_cache.stats()})
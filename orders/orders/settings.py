@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'backend.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -132,6 +133,17 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STORAGE = os.path.join(BASE_DIR, 'storage')
 
+# Price list import
+
+IMPORT_BATCH_SIZE = 1000
+PRICE_FEED_INTERVAL = 60 * 60
+PRICE_FEED_WORKERS = 8
+PRICE_FEED_TIMEOUT = 30
+
+# Category/Parameter/Product lookup cache
+
+LOOKUP_CACHE_SIZE = 10000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -152,26 +164,80 @@ EMAIL_PORT = '465'
 EMAIL_USE_SSL = True
 SERVER_EMAIL = EMAIL_HOST_USER
 
+# Outbox: mail is stored with the request transaction and sent in batches over one SMTP connection
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_LEASE = 5 * 60
+OUTBOX_DRAIN_INTERVAL = 60
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'backend.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_RENDERER_CLASSES': [
+        'backend.renderers.UJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'backend.renderers.MessagePackRenderer',
+    ],
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        'backend.throttling.SharedAnonRateThrottle',
+        'backend.throttling.SharedUserRateThrottle'
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '50/day',
         'user': '1000/day'
-    }
+    },
 }
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+SEARCH_MAX_RESULTS = 1000
+STREAM_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = 2000
+
+COMPRESS_CONTENT_TYPES = ('application/json', 'application/msgpack', 'text/csv',
+                          'application/x-ndjson')
+COMPRESS_MIN_LENGTH = 200
+BROTLI_QUALITY = 4
+
 # Celery
 
 REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PORT = os.environ.get('REDIS_PORT')
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
 CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+
+# Redis for application caches, memory:// keeps them inside the process
+
+REDIS_URL = os.environ.get('REDIS_URL') or f'redis://{REDIS_HOST}:{REDIS_PORT}/1'
+REDIS_TIMEOUT = 0.5
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Token -> user cache: per process LRU in front of Redis, a local hit checks
+# the revocation marker in Redis; while Redis is down a process sees
+# invalidations made by other processes after AUTH_LOCAL_TIMEOUT seconds
+
+AUTH_CACHE_SIZE = 10000
+AUTH_LOCAL_TIMEOUT = 30
+AUTH_CACHE_TIMEOUT = 60 * 60
+
+# After a Redis connection error or timeout throttling lets requests through
+# without asking Redis for THROTTLE_REDIS_BACKOFF seconds
+
+THROTTLE_REDIS_BACKOFF = 5
+
+CELERY_BEAT_SCHEDULE = {
+    'pull-price-lists': {
+        'task': 'backend.tasks.pull_price_lists',
+        'schedule': PRICE_FEED_INTERVAL,
+    },
+    'drain-outbox': {
+        'task': 'backend.tasks.drain_outbox',
+        'schedule': OUTBOX_DRAIN_INTERVAL,
+    },
+}